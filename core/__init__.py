@@ -2,6 +2,7 @@ import json
 import logging
 import logging.config
 import os
+import re
 import shutil
 import uuid
 from contextlib import contextmanager
@@ -33,6 +34,7 @@ def get_conf(conf=None):
     with v.parsing(additional_properties=False):
         schema = v.parse({
             'debug': v.Nullable(bool, False),
+            'debug_sql': v.Nullable(bool, False),
             '+pg_username': str,
             '+pg_password': str,
             '+cookie_secret': str,
@@ -47,6 +49,8 @@ def get_conf(conf=None):
             'log_file': v.Nullable(str, ''),
             'path_attachments': v.Nullable(str, str(base_dir / 'attachments')),
             'path_theme': v.Nullable(exists, str(base_dir / 'front')),
+            'path_cache': v.Nullable(str, str(base_dir / 'cache')),
+            'cache_maxsize': v.Nullable(int, 256 * 1024 * 1024),
             'imap_body_maxsize': v.Nullable(int, 50 * 1024 * 1024),
             'imap_batch_size': v.Nullable(int, 2000),
             'imap_debug': v.Nullable(int, 0),
@@ -64,7 +68,9 @@ def get_conf(conf=None):
             'ui_thread_few': v.Nullable(int, 5),
             'host_ws': v.Nullable(str, 'ws://localhost/async/'),
             'host_web': v.Nullable(strip_slash, 'http://localhost:8000'),
-            'search_lang': v.Nullable([str], ['simple', 'english']),
+            'search_lang': (
+                v.Nullable([str], ['simple', 'english', 'russian'])
+            ),
         })
     conf = schema.validate(conf)
 
@@ -89,6 +95,12 @@ class Theme():
             with path.open('br') as f:
                 return f.read()
 
+    def open(self, subpath, mode='br'):
+        path = self.path(subpath)
+        if 'w' in mode:
+            os.makedirs(str(path.parent), exist_ok=True)
+        return path.open(mode)
+
     def write(self, subpath, data, rewrite=False):
         path = self.path(subpath)
         if not rewrite and path.exists():
@@ -97,8 +109,7 @@ class Theme():
         if isinstance(data, str):
             data = data.encode()
 
-        os.makedirs(str(path.parent), exist_ok=True)
-        with path.open('bw') as f:
+        with self.open(subpath, 'bw') as f:
             return f.write(data)
 
 
@@ -148,6 +159,68 @@ class Files(Theme):
             shutil.rmtree(str(path))
 
 
+class Cache(Theme):
+    """Local on-disk storage, least recently used entries go first"""
+    def __init__(self, env):
+        self.base_path = Path(env('path_cache')) / env.username
+        self.maxsize = env('cache_maxsize')
+        self.size = None
+
+    def subpath(self, key):
+        return '%s/%s' % (key[:2], key)
+
+    def get(self, key):
+        path = self.path(self.subpath(key))
+        try:
+            with path.open('br') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+
+        # Modification time is the last access time
+        os.utime(str(path))
+        return json.loads(data.decode())
+
+    def set(self, key, value):
+        data = json.dumps(value).encode()
+        subpath = self.subpath(key)
+        tmp = '%s.%s.tmp' % (subpath, uuid.uuid4().hex)
+        with self.open(tmp, 'bw') as f:
+            f.write(data)
+        os.replace(str(self.path(tmp)), str(self.path(subpath)))
+
+        if self.size is None:
+            self.size = sum(size for path, size, time in self.entries())
+        else:
+            self.size += len(data)
+        if self.size > self.maxsize:
+            self.evict()
+
+    def entries(self):
+        if not self.base_path.exists():
+            return
+
+        for folder in os.scandir(str(self.base_path)):
+            if not folder.is_dir():
+                continue
+            for entry in os.scandir(folder.path):
+                stat = entry.stat()
+                yield entry.path, stat.st_size, stat.st_mtime
+
+    def evict(self):
+        entries = sorted(self.entries(), key=lambda e: e[2])
+        self.size = sum(size for path, size, time in entries)
+        # Free some more room, so eviction doesn't run on every write
+        for path, size, time in entries:
+            if self.size <= self.maxsize * 0.9:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+
+
 class Env:
     def __init__(self, username=None, conf=None):
         conf = get_conf(conf)
@@ -156,6 +229,11 @@ class Env:
 
         self.storage = db.Storage(self)
         self.emails = db.Emails(self)
+        self.bodies = db.Bodies(self)
+        self.search_queue = db.SearchQueue(self)
+        self.contacts = db.Contacts(self)
+        # Address indexes of all users served by the process
+        self.addresses_by_user = {}
 
         # General setup
         self.username = None
@@ -190,19 +268,29 @@ class Env:
 
     @username.setter
     def username(self, value):
+        # Keep connection (and its prepared statements) for the same user
+        db = self.__dict__.get('db')
+        if value != self.__dict__.get('username') or db and db.closed:
+            self.db_reset()
+            self.__dict__.pop('cache', None)
         self.__dict__['username'] = value
 
         # Clear cached properties
-        self.__dict__.pop('db', None)
         self.__dict__.pop('conf', None)
         self.__dict__.pop('email', None)
         self.__dict__.pop('token', None)
         self.__dict__.pop('files', None)
+        self.__dict__.pop('labels', None)
+        self.__dict__.pop('charsets', None)
 
     @cached_property
     def db(self):
         return self.db_connect()
 
+    def db_reset(self):
+        self.__dict__.pop('db', None)
+        self.__dict__.pop('prepared', None)
+
     @cached_property
     def conf(self):
         try:
@@ -228,6 +316,26 @@ class Env:
     def files(self):
         return Files(self)
 
+    @cached_property
+    def cache(self):
+        return Cache(self)
+
+    @property
+    def addresses(self):
+        addresses = self.addresses_by_user.get(self.username)
+        if addresses is None:
+            addresses = db.Addresses(self)
+            self.addresses_by_user[self.username] = addresses
+        return addresses
+
+    @cached_property
+    def labels(self):
+        return db.Labels(self)
+
+    @cached_property
+    def charsets(self):
+        return db.Charsets(self)
+
     @property
     def db_name(self):
         if not self.username:
@@ -250,9 +358,14 @@ class Env:
     @contextmanager
     def db_cursor(self, connect_params=None, **params):
         connect_params = connect_params or {}
-        with self.db_connect(**connect_params) as conn:
-            with conn.cursor(**params) as cur:
-                yield cur
+        conn = self.db_connect(**connect_params)
+        try:
+            # Commits on success, but doesn't close connection itself
+            with conn:
+                with conn.cursor(**params) as cur:
+                    yield cur
+        finally:
+            conn.close()
 
     def _sql(self, method, sql, *args, **opts):
         opts = dict({'cursor_factory': psycopg2.extras.DictCursor}, **opts)
@@ -266,6 +379,40 @@ class Env:
     def sqlmany(self, *args, **kwargs):
         return self._sql('executemany', *args, **kwargs)
 
+    @cached_property
+    def prepared(self):
+        # Statements prepared on current connection: {name: sql}
+        return {}
+
+    def sql_prepared(self, name, sql, params=(), types=(), explain=False):
+        from .helpers import Timer
+
+        if explain and not re.match(r'\s*SELECT\b', sql, re.I):
+            # EXPLAIN ANALYZE runs statement second time
+            raise ValueError('Only SELECT can be explained: %r' % name)
+
+        if self.prepared.get(name) != sql:
+            if name in self.prepared:
+                self.sql('DEALLOCATE %s' % name)
+            timer = Timer()
+            self.sql('PREPARE {}{} AS {}'.format(
+                name, ('(%s)' % ', '.join(types)) if types else '', sql
+            ))
+            self.prepared[name] = sql
+            log.debug('Prepare %r for %.2fms', name, timer.time() * 1000)
+
+        execute = 'EXECUTE %s' % name
+        if params:
+            execute += '(%s)' % ', '.join(['%s'] * len(params))
+        if explain and self('debug_sql'):
+            explain = 'EXPLAIN (ANALYZE, FORMAT JSON) %s' % execute
+            plan = self.sql(explain, params).fetchone()[0][0]
+            log.debug(
+                'Execute %r: planning=%.2fms execution=%.2fms', name,
+                plan['Planning Time'], plan['Execution Time']
+            )
+        return self.sql(execute, params)
+
     def mogrify(self, sql, params):
         result = self.db.cursor().mogrify(sql, params)
         return result.decode()
@@ -307,7 +454,7 @@ class Env:
 
         # check db_connect
         try:
-            self.db_connect()
+            self.db
             return True
         except ValueError:
             return False
@@ -8,6 +8,7 @@ from werkzeug.utils import cached_property, redirect
 from werkzeug.wrappers import Request as _Request, Response
 
 from . import Env, log
+from .helpers import LRU
 
 
 class Request(_Request):
@@ -38,6 +39,8 @@ class WebEnv(Env):
         super().__init__()
         self.views = views
         self.url_map = views.url_map
+        # Rendered people shared by requests, see views.ctx_person
+        self.persons = LRU(10000)
 
     def set_request(self, request):
         self.request = request
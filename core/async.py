@@ -49,19 +49,29 @@ def wshandler(request):
             payload = data.get('payload')
             if payload:
                 payload = json.dumps(payload)
+            headers = {
+                'X-Requested-With': 'XMLHttpRequest',
+                'Cookie': data['cookie']
+            }
+            if data.get('etag'):
+                headers['If-None-Match'] = data['etag']
             resp = yield from aiohttp.request(
                 'POST' if payload else 'GET',
                 env('host_web') + data['url'],
-                headers={
-                    'X-Requested-With': 'XMLHttpRequest',
-                    'Cookie': data['cookie']
-                },
+                headers=headers,
                 data=payload,
             )
             log.debug('%s %s', resp.status, msg.data)
-            if resp.status == 200:
-                p = (yield from resp.read()).decode()
-                ws.send_str(json.dumps({'uid': data['uid'], 'payload': p}))
+            if resp.status in (200, 304):
+                if resp.status == 304:
+                    reply = {'uid': data['uid'], 'not_modified': True}
+                else:
+                    reply = {
+                        'uid': data['uid'],
+                        'payload': (yield from resp.read()).decode(),
+                        'etag': resp.headers.get('ETag'),
+                    }
+                ws.send_str(json.dumps(reply))
                 new_session = resp.cookies.get('session')
                 if new_session and session != new_session:
                     session = new_session.value
@@ -1,4 +1,13 @@
+import binascii
+import bisect
+import datetime as dt
+import hashlib
+import heapq
+import io
+import itertools
+import time
 import uuid
+from collections import Counter
 
 import psycopg2
 import psycopg2.extras
@@ -7,6 +16,11 @@ import rapidjson as json
 psycopg2.extensions.register_adapter(dict, psycopg2.extras.Json)
 psycopg2.extensions.register_adapter(uuid.UUID, psycopg2.extras.UUID_adapter)
 
+# Escaping for text format of COPY
+COPY_ESCAPE = str.maketrans({
+    '\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'
+})
+
 
 def init(env, password=None, reset=False):
     if reset:
@@ -30,7 +44,12 @@ def init(env, password=None, reset=False):
     END;
     $$ language 'plpgsql';
     '''
-    sql += ';'.join(t.table for t in [Storage, Emails])
+    sql += ';'.join(
+        t.table for t in [
+            Storage, Labels, Charsets, Emails, Bodies, SearchQueue,
+            Contacts, EmailContacts
+        ]
+    )
     env.sql(sql)
     env.db.commit()
 
@@ -79,8 +98,34 @@ def create_table(name, body, before=None, after=None):
     return '; '.join(before + sql + after)
 
 
+def copy_value(value, type_=None):
+    if value is None:
+        return '\\N'
+    elif type_ in ('json', 'jsonb') and not isinstance(value, str):
+        # Strings are JSON already like for query parameters
+        value = json.dumps(value, ensure_ascii=False)
+    elif isinstance(value, bool):
+        value = 't' if value else 'f'
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        value = '\\x' + binascii.hexlify(value).decode()
+    elif isinstance(value, (list, tuple)):
+        value = '{%s}' % ','.join(
+            'NULL' if v is None else
+            '"%s"' % str(v).replace('\\', '\\\\').replace('"', '\\"')
+            for v in value
+        )
+    elif isinstance(value, dict):
+        value = json.dumps(value, ensure_ascii=False)
+    elif isinstance(value, dt.datetime):
+        value = value.isoformat(' ')
+    else:
+        value = str(value)
+    return value.translate(COPY_ESCAPE)
+
+
 class Manager():
     pk = 'id'
+    touch = None
 
     def __init__(self, env):
         self.env = env
@@ -98,10 +143,7 @@ class Manager():
     def get_field(self, name):
         if name not in self.field_names:
             raise ValueError('Wrong field: %s', name)
-        field = [
-            i for i in self.fields
-            if i.startswith(name) or i.startswith('"' + name)
-        ][0]
+        field = [i for i in self.fields if i.split()[0].strip('"') == name][0]
         return field
 
     def get_fields(self, fields):
@@ -111,60 +153,131 @@ class Manager():
             raise ValueError('No fields: %s' % error)
         return fields
 
+    def get_type(self, name):
+        type_ = self.get_field(name).split()[1]
+        return {'serial': 'int', 'bigserial': 'bigint'}.get(type_, type_)
+
     def sql_fields(self, fields):
         fields = self.get_fields(fields)
         return '(%s)' % ', '.join('"%s"' % i for i in fields)
 
-    def sql_values(self, items):
-        if isinstance(items, dict):
-            items = [items]
-
-        fields = self.get_fields(items[0])
-        pattern = '(%s)' % ', '.join('%%(%s)s' % i for i in fields)
-        values = ','.join([self.mogrify(pattern, v) for v in items])
-        return values
+    def sql_values(self, items, fields):
+        # Placeholders of prepared statement: ($1, $2), ($3, $4), ...
+        size = len(fields)
+        values = ', '.join(
+            '(%s)' % ', '.join('$%s' % (n + i + 1) for i in range(size))
+            for n in range(0, len(items) * size, size)
+        )
+        params = [i[f] for i in items for f in fields]
+        types = [self.get_type(f) for f in fields] * len(items)
+        return values, params, types
+
+    def sql_prepared(self, action, sql, params, types):
+        # Statement per query text, so the same batch shape is reused
+        name = '%s_%s_%s' % (
+            self.name, action, hashlib.md5(sql.encode()).hexdigest()[:10]
+        )
+        return self.env.sql_prepared(name, sql, params, types)
 
     def insert(self, items):
         if isinstance(items, dict):
             items = [items]
 
-        i = self.sql('''
+        fields = self.get_fields(items[0])
+        values, params, types = self.sql_values(items, fields)
+        i = self.sql_prepared('insert', '''
         INSERT INTO {table} {fields} VALUES {values} RETURNING {pk}
         '''.format(
             table=self.name,
             pk=self.pk,
-            fields=self.sql_fields(items[0].keys()),
-            values=self.sql_values(items)
-        ))
+            fields=self.sql_fields(fields),
+            values=values
+        ), params, types)
         return [r[0] for r in i]
 
+    def copy(self, items):
+        if isinstance(items, dict):
+            items = [items]
+        if not items:
+            return 0
+
+        fields = self.get_fields(items[0])
+        types = [self.get_type(f) for f in fields]
+        data = ''.join(
+            '\t'.join(copy_value(i[f], t) for f, t in zip(fields, types))
+            + '\n'
+            for i in items
+        )
+        cur = self.db.cursor()
+        cur.copy_expert('COPY {table} {fields} FROM STDIN'.format(
+            table=self.name,
+            fields=self.sql_fields(fields)
+        ), io.StringIO(data))
+        return cur.rowcount
+
     def update(self, values, where, params=None):
+        fields = self.get_fields(values)
         i = self.sql('''
-        UPDATE {table} SET {fields} = {values}
+        UPDATE {table} SET {fields}{touch}
             WHERE {where}
             RETURNING {pk}
         '''.format(
             table=self.name,
             pk=self.pk,
-            fields=self.sql_fields(values.keys()),
-            values=self.sql_values(values),
-            where=self.mogrify(where, params)
-        ))
+            fields=', '.join('"%s" = %%s' % f for f in fields),
+            touch=(', %s' % self.touch) if self.touch else '',
+            where=where
+        ), [values[f] for f in fields] + list(params or []))
         return [r[0] for r in i]
 
-    def upsert(self, values, where, params=None):
-        return self.sql('''
-        UPDATE {table} SET {fields} = {values} WHERE {where};
-        INSERT INTO {table} {fields}
-            SELECT {select}
-            WHERE NOT EXISTS (SELECT 1 FROM {table} WHERE {where});
+    def update_many(self, items, key=None):
+        if not items:
+            return []
+
+        key = key or self.pk
+        fields = self.get_fields(items[0])
+        values, params, types = self.sql_values(items, fields)
+        i = self.sql_prepared('update', '''
+        UPDATE {table} t SET {fields}{touch}
+            FROM (VALUES {values}) AS v({names})
+            WHERE t."{key}" = v."{key}"
+            RETURNING t.{pk}
         '''.format(
             table=self.name,
-            fields=self.sql_fields(values.keys()),
-            values=self.sql_values(values),
-            select=self.sql_values(values)[1:-1:],
-            where=self.mogrify(where, params)
-        ))
+            pk=self.pk,
+            key=key,
+            fields=', '.join(
+                '"{0}" = v."{0}"'.format(f) for f in fields if f != key
+            ),
+            touch=(', %s' % self.touch) if self.touch else '',
+            values=values,
+            names=', '.join('"%s"' % f for f in fields)
+        ), params, types)
+        return [r[0] for r in i]
+
+    def upsert(self, items):
+        if isinstance(items, dict):
+            items = [items]
+
+        fields = self.get_fields(items[0])
+        values, params, types = self.sql_values(items, fields)
+        update = ', '.join(
+            '"{0}" = EXCLUDED."{0}"'.format(f) for f in fields if f != self.pk
+        )
+        if update and self.touch:
+            update += ', %s' % self.touch
+        i = self.sql_prepared('upsert', '''
+        INSERT INTO {table} {fields} VALUES {values}
+            ON CONFLICT ("{pk}") DO {action}
+            RETURNING {pk}
+        '''.format(
+            table=self.name,
+            pk=self.pk,
+            fields=self.sql_fields(fields),
+            values=values,
+            action=('UPDATE SET %s' % update) if update else 'NOTHING'
+        ), params, types)
+        return [r[0] for r in i]
 
 
 class Key():
@@ -209,7 +322,7 @@ class Storage(Manager):
 
     def set(self, key, value):
         value = json.dumps(value, ensure_ascii=False)
-        self.upsert({'key': key, 'value': value}, 'key=%s', [key])
+        self.upsert({'key': key, 'value': value})
         self.db.commit()
 
     def rm(self, key):
@@ -220,16 +333,159 @@ class Storage(Manager):
         targets = {
             'compose': lambda thrid: 'compose:%s' % (thrid or 'new'),
             'folder': lambda uid: 'folder:%s' % uid,
+            'parse': lambda where: 'parse:%s' % where,
         }
         return Key(self, targets[name](**params))
 
 
+class Labels(Manager):
+    name = 'labels'
+    fields = (
+        'id serial PRIMARY KEY',
+        'name varchar NOT NULL UNIQUE',
+        'created timestamp NOT NULL DEFAULT current_timestamp',
+    )
+    table = create_table(name, fields)
+
+    # Seconds before unknown names are looked up in the table again
+    missing_ttl = 10
+
+    def __init__(self, env):
+        super().__init__(env)
+        self.by_id, self.by_name = {}, {}
+        self.loaded = 0
+
+    def load(self):
+        i = self.sql('SELECT id, name FROM labels')
+        self.by_id = dict(i)
+        self.by_name = {v: k for k, v in self.by_id.items()}
+        self.loaded = time.time()
+
+    def create(self, names):
+        # Use separate connection, so new labels survive a rollback
+        with self.env.db_cursor() as cur:
+            cur.execute('''
+            INSERT INTO labels (name) SELECT unnest(%s::varchar[])
+            ON CONFLICT (name) DO NOTHING
+            ''', [sorted(set(names))])
+
+    def get_ids(self, names, create=False):
+        names = [names] if isinstance(names, str) else list(names)
+        missing = [n for n in names if n not in self.by_name]
+        if missing and create:
+            self.create(missing)
+            self.load()
+        elif missing and time.time() - self.loaded > self.missing_ttl:
+            # Names like "\\Pinned" may not exist, so not on every lookup
+            self.load()
+        # Unknown label gets zero id, which matches no email
+        return [self.by_name.get(n, 0) for n in names]
+
+    def get_id(self, name, create=False):
+        return self.get_ids([name], create)[0]
+
+    def get_name(self, id):
+        names = self.get_names([id])
+        return names[0] if names else None
+
+    def get_names(self, ids):
+        ids = list(ids or [])
+        if set(ids) - set(self.by_id):
+            self.load()
+        return [self.by_id[i] for i in ids if i in self.by_id]
+
+
+class Charsets(Manager):
+    name = 'charsets'
+    pk = 'domain'
+    fields = (
+        'domain varchar PRIMARY KEY',
+        'charset varchar NOT NULL',
+        'created timestamp NOT NULL DEFAULT current_timestamp',
+    )
+    table = create_table(name, fields)
+
+    # Messages with the same detected charset needed to learn it
+    votes_min = 3
+
+    def __init__(self, env):
+        super().__init__(env)
+        self.by_domain = None
+        # How often every path of charset decoding is taken
+        self.stats = Counter()
+        self.votes = Counter()
+
+    def get(self, domain):
+        if self.by_domain is None:
+            i = self.sql('SELECT domain, charset FROM charsets')
+            self.by_domain = dict(i)
+        return self.by_domain.get(domain)
+
+    def vote(self, domain, charset):
+        self.votes[(domain, charset)] += 1
+        if self.votes[(domain, charset)] >= self.votes_min:
+            self.learn(domain, charset)
+
+    def learn(self, domain, charset):
+        if self.get(domain) == charset:
+            return
+
+        self.by_domain[domain] = charset
+        self.sql('''
+        INSERT INTO charsets (domain, charset) VALUES (%s, %s)
+        ON CONFLICT (domain) DO UPDATE SET charset = EXCLUDED.charset
+        ''', [domain, charset])
+
+
+def migrate_charsets(env):
+    i = env.sql('''
+    SELECT 1 FROM information_schema.tables WHERE table_name = 'charsets'
+    ''').fetchone()
+    if i:
+        return False
+
+    env.sql(Charsets.table)
+    env.db.commit()
+    return True
+
+
+def migrate_labels(env):
+    i = env.sql('''
+    SELECT udt_name FROM information_schema.columns
+    WHERE table_name = 'emails' AND column_name = 'labels'
+    ''').fetchone()
+    if not i or i[0] != '_varchar':
+        return False
+
+    env.sql(Labels.table)
+    env.sql('''
+    INSERT INTO labels (name)
+    SELECT DISTINCT unnest(labels) FROM emails
+    EXCEPT SELECT name FROM labels
+    ORDER BY 1;
+
+    ALTER TABLE emails ADD COLUMN labels_ int[] NOT NULL DEFAULT '{}';
+    UPDATE emails e SET labels_ = ARRAY(
+        SELECT l.id FROM labels l WHERE l.name = ANY(e.labels) ORDER BY 1
+    );
+    DROP INDEX IF EXISTS ix_emails_labels;
+    ALTER TABLE emails DROP COLUMN labels;
+    ALTER TABLE emails RENAME COLUMN labels_ TO labels;
+    ''')
+    env.sql(create_index('emails', 'labels', 'GIN'))
+    env.db.commit()
+    return True
+
+
 class Emails(Manager):
     name = 'emails'
+    # Should be set by every statement changing emails, no trigger here
+    touch = "version=nextval('seq_emails_version'), updated=now()"
     fields = (
         'id bigint PRIMARY KEY',
         'created timestamp NOT NULL DEFAULT current_timestamp',
         'updated timestamp NOT NULL DEFAULT current_timestamp',
+        'version bigint',
         'msgid varchar UNIQUE',
         'extid varchar UNIQUE',
         'delid uuid NOT NULL',  # remove after migrating
@@ -238,13 +494,16 @@ class Emails(Manager):
         'parent bigint REFERENCES emails(id)',
         'duplicate bigint REFERENCES emails(id)',
 
-        'header bytea',
-        'raw bytea',
         'size int',
         'time timestamp',
-        "labels varchar[] NOT NULL DEFAULT '{}'",
+        "labels int[] NOT NULL DEFAULT '{}'",
 
         'subj varchar',
+        # Subject and addresses for threading, see filters.normalize_subj
+        'subj_norm varchar',
+        'participants varchar',
+        # Snippet of text for lists, so they don't read bodies
+        'preview varchar',
         "fr varchar[] NOT NULL DEFAULT '{}'",
         '"to" varchar[] NOT NULL DEFAULT \'{}\'',
         "cc varchar[] NOT NULL DEFAULT '{}'",
@@ -254,17 +513,11 @@ class Emails(Manager):
         'sender_time timestamp',
         'in_reply_to varchar',
         "refs varchar[] NOT NULL DEFAULT '{}'",
-
-        'text text',
-        'html text',
-        "attachments jsonb",
-        "embedded jsonb",
-
-        'search tsvector',
     )
     table = create_table(name, fields, after=(
-        fill_updated(name),
         create_seq(name, 'id'),
+        create_seq(name, 'version'),
+        create_index(name, 'version'),
         create_index(name, 'size'),
         create_index(name, 'msgid'),
         create_index(name, 'thrid'),
@@ -272,5 +525,453 @@ class Emails(Manager):
         create_index(name, 'in_reply_to'),
         create_index(name, 'refs', 'GIN'),
         create_index(name, 'labels', 'GIN'),
-        create_index(name, 'search', 'GIN')
+        'DROP INDEX IF EXISTS ix_emails_participants',
+        'CREATE INDEX ix_emails_participants '
+        'ON emails (participants, subj_norm)',
     ))
+
+    def version(self):
+        i = self.sql('SELECT max(version) FROM emails')
+        return i.fetchone()[0] or 0
+
+
+def migrate_version(env):
+    i = env.sql('''
+    SELECT 1 FROM information_schema.columns
+    WHERE table_name = 'emails' AND column_name = 'version'
+    ''').fetchone()
+    if i:
+        return False
+
+    env.sql('''
+    DROP TRIGGER IF EXISTS fill_emails_updated ON emails;
+    ALTER TABLE emails ADD COLUMN version bigint;
+    ''')
+    env.sql(create_seq('emails', 'version'))
+    env.sql("UPDATE emails SET version=nextval('seq_emails_version')")
+    env.sql(create_index('emails', 'version'))
+    env.db.commit()
+    return True
+
+
+class Bodies(Manager):
+    name = 'bodies'
+    fields = (
+        'id bigint PRIMARY KEY REFERENCES emails(id) ON DELETE CASCADE',
+
+        'header bytea',
+        'raw bytea',
+
+        'text text',
+        'html text',
+        "attachments jsonb",
+        "embedded jsonb",
+        # Fingerprint of text to find it quoted in replies, see filters
+        'quote varchar',
+        # Version of parser, so emails can be parsed again after changes
+        'parser_version int',
+        # Search configurations detected by text, see syncer.detect_langs
+        'lang varchar[]',
+
+        'search tsvector',
+    )
+    table = create_table(name, fields, after=(
+        create_index(name, 'search', 'GIN'),
+    ))
+
+
+class SearchQueue(Manager):
+    name = 'search_queue'
+    pk = 'seq'
+    fields = (
+        'seq bigserial PRIMARY KEY',
+        'id bigint NOT NULL REFERENCES emails(id) ON DELETE CASCADE',
+        'created timestamp NOT NULL DEFAULT current_timestamp',
+    )
+    table = create_table(name, fields)
+
+    def push(self, ids):
+        self.sql('''
+        INSERT INTO search_queue (id) SELECT unnest(%s::bigint[])
+        ''', [list(ids)])
+
+    def pop(self, limit):
+        # Other indexer can work on the next rows at the same time
+        i = self.sql('''
+        DELETE FROM search_queue WHERE seq IN (
+            SELECT seq FROM search_queue ORDER BY seq LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING seq, id
+        ''', [limit])
+        return i.fetchall()
+
+    def count(self):
+        return self.sql('SELECT count(*) FROM search_queue').fetchone()[0]
+
+
+class Contacts(Manager):
+    name = 'contacts'
+    fields = (
+        'id serial PRIMARY KEY',
+        'addr varchar NOT NULL UNIQUE',
+        'name varchar',
+        # How many times and when the user sent an email to the address
+        'sent int NOT NULL DEFAULT 0',
+        'last_used timestamp',
+        # Set on every change, so Addresses can be refreshed incrementally
+        'version bigint',
+    )
+    table = create_table(name, fields, after=(
+        create_seq(name, 'version'),
+        create_index(name, 'version'),
+        # Prefix lookups ("LIKE 'q%'") for autocomplete
+        'DROP INDEX IF EXISTS ix_contacts_addr_prefix',
+        'CREATE INDEX ix_contacts_addr_prefix '
+        'ON contacts (addr varchar_pattern_ops)',
+        'DROP INDEX IF EXISTS ix_contacts_name_prefix',
+        'CREATE INDEX ix_contacts_name_prefix '
+        'ON contacts (lower(name) varchar_pattern_ops)',
+    ))
+
+    # Addresses are formatted like '"name" <addr>' by syncer.get_parsed
+    addresses = '''
+    SELECT id, field,
+        lower(substring(value from '<([^<>]*)>$')) AS addr,
+        substring(value from '^"(.*)" <[^<>]*>$') AS name
+    FROM emails e, LATERAL (
+        SELECT 'fr', unnest(e.fr)
+        UNION ALL SELECT 'to', unnest(e."to")
+        UNION ALL SELECT 'cc', unnest(e.cc)
+        UNION ALL SELECT 'bcc', unnest(e.bcc)
+    ) a(field, value)
+    WHERE {where}
+    '''
+
+    def link(self, ids=None):
+        if ids is None:
+            where = 'true'
+        else:
+            where = self.mogrify('e.id = ANY(%s::bigint[])', [list(ids)])
+        addresses = self.addresses.format(where=where)
+
+        self.sql('''
+        INSERT INTO contacts (addr, name)
+        SELECT DISTINCT ON (addr) addr, name FROM ({addresses}) a
+        WHERE addr IS NOT NULL AND NOT EXISTS (
+            -- Don't waste values of sequence on conflicts
+            SELECT 1 FROM contacts c WHERE c.addr = a.addr
+        )
+        ORDER BY addr, name
+        ON CONFLICT (addr) DO NOTHING;
+
+        DELETE FROM email_contacts e WHERE {where};
+
+        INSERT INTO email_contacts (id, contact_id, field)
+        SELECT DISTINCT a.id, c.id, a.field
+        FROM ({addresses}) a JOIN contacts c ON c.addr = a.addr;
+        '''.format(addresses=addresses, where=where))
+
+        if not self.env.email:
+            return
+
+        # Pairs of (email, recipient) for emails sent by the user
+        sent = '''
+        SELECT r.id, r.contact_id FROM email_contacts f
+        JOIN email_contacts r ON r.id = f.id AND r.field != 'fr'
+            AND r.contact_id != f.contact_id
+        WHERE f.field = 'fr' AND f.contact_id = (
+            SELECT id FROM contacts WHERE addr = lower(%(email)s)
+        )
+        '''
+        recount = 'true'
+        if ids is not None:
+            # Recount only recipients from given emails
+            recount = '''
+            s.contact_id IN (
+                SELECT contact_id FROM ({sent}) s
+                WHERE s.id = ANY(%(ids)s::bigint[])
+            )
+            '''.format(sent=sent)
+        self.sql('''
+        UPDATE contacts c SET
+            sent = s.sent,
+            last_used = s.last_used,
+            version = nextval('seq_contacts_version')
+        FROM (
+            SELECT
+                s.contact_id,
+                count(DISTINCT s.id) AS sent,
+                max(e.time) AS last_used
+            FROM ({sent}) s JOIN emails e ON e.id = s.id
+            WHERE {recount}
+            GROUP BY s.contact_id
+        ) s
+        WHERE c.id = s.contact_id
+            AND (c.sent, c.last_used) IS DISTINCT FROM (s.sent, s.last_used)
+        '''.format(sent=sent, recount=recount), {
+            'email': self.env.email,
+            'ids': list(ids or []),
+        })
+
+
+class Addresses():
+    """In-memory prefix index over addresses the user sent emails to"""
+    limit = 100
+    # Seconds between checks for changed contacts
+    interval = 10
+
+    def __init__(self, env):
+        self.env = env
+        self.version = 0
+        self.checked = 0
+        # Sorted pairs of (prefix key, contact id) for bisect
+        self.keys = []
+        # {contact id: (rank, text, prefix keys)}
+        self.by_id = {}
+        # Contact ids from the most used
+        self.ranked = []
+
+    def refresh(self):
+        if time.monotonic() - self.checked < self.interval:
+            return
+
+        self.checked = time.monotonic()
+        version = self.env.sql('SELECT max(version) FROM contacts')
+        version = version.fetchone()[0] or 0
+        if version == self.version:
+            return
+
+        i = self.env.sql('''
+        SELECT id, addr, name, sent, last_used FROM contacts
+        WHERE version > %s AND version <= %s AND sent > 0
+        ''', [self.version, version])
+        self.update(i)
+        self.version = version
+
+    def update(self, rows):
+        keys = []
+        for id, addr, name, sent, last_used in rows:
+            prefixes = (addr, name.lower()) if name else (addr,)
+            if id not in self.by_id:
+                keys.extend((k, id) for k in prefixes)
+            text = '"{}" <{}>'.format(name or addr.split('@')[0], addr)
+            rank = (last_used or dt.datetime.min, sent)
+            self.by_id[id] = (rank, text, prefixes)
+
+        if len(keys) > len(self.keys) // 10:
+            self.keys = sorted(self.keys + keys)
+        else:
+            for key in keys:
+                bisect.insort(self.keys, key)
+        self.ranked = sorted(
+            self.by_id, key=lambda i: self.by_id[i][0], reverse=True
+        )
+
+    def search(self, query):
+        self.refresh()
+
+        query = query.lower()
+        start = bisect.bisect_left(self.keys, (query,))
+        end = bisect.bisect_left(self.keys, (query + '\U0010ffff',))
+        if end - start > self.limit * 10:
+            # Short prefix matches a lot, so take the most used first
+            ids = (
+                i for i in self.ranked
+                if any(k.startswith(query) for k in self.by_id[i][2])
+            )
+            ids = itertools.islice(ids, self.limit)
+        else:
+            ids = {id for key, id in self.keys[start:end]}
+            ids = heapq.nlargest(
+                self.limit, ids, key=lambda i: self.by_id[i][0]
+            )
+        return [self.by_id[i][1] for i in ids]
+
+
+class EmailContacts(Manager):
+    name = 'email_contacts'
+    fields = (
+        'id bigint NOT NULL REFERENCES emails(id) ON DELETE CASCADE',
+        'contact_id int NOT NULL REFERENCES contacts(id)',
+        # One of address fields of emails: fr, to, cc, bcc
+        'field varchar NOT NULL',
+        'PRIMARY KEY (contact_id, field, id)',
+    )
+    table = create_table(name, fields, after=(
+        create_index(name, 'id'),
+    ))
+
+
+def migrate_bodies(env):
+    i = env.sql('''
+    SELECT 1 FROM information_schema.columns
+    WHERE table_name = 'emails' AND column_name = 'raw'
+    ''').fetchone()
+    if not i:
+        return False
+
+    env.sql(Bodies.table)
+    env.sql('''
+    INSERT INTO bodies (
+        id, header, raw, text, html, attachments, embedded, search
+    )
+    SELECT id, header, raw, text, html, attachments, embedded, search
+    FROM emails;
+
+    DROP INDEX IF EXISTS ix_emails_search;
+    ALTER TABLE emails
+        DROP COLUMN header,
+        DROP COLUMN raw,
+        DROP COLUMN text,
+        DROP COLUMN html,
+        DROP COLUMN attachments,
+        DROP COLUMN embedded,
+        DROP COLUMN search;
+    ''')
+    env.db.commit()
+    return True
+
+
+def migrate_quote(env):
+    i = env.sql('''
+    SELECT 1 FROM information_schema.columns
+    WHERE table_name = 'bodies' AND column_name = 'quote'
+    ''').fetchone()
+    if i:
+        return False
+
+    env.sql('ALTER TABLE bodies ADD COLUMN quote varchar')
+    env.db.commit()
+    return True
+
+
+def migrate_parser_version(env):
+    i = env.sql('''
+    SELECT 1 FROM information_schema.columns
+    WHERE table_name = 'bodies' AND column_name = 'parser_version'
+    ''').fetchone()
+    if i:
+        return False
+
+    env.sql('ALTER TABLE bodies ADD COLUMN parser_version int')
+    env.db.commit()
+    return True
+
+
+def migrate_search_queue(env):
+    i = env.sql('''
+    SELECT 1 FROM information_schema.tables
+    WHERE table_name = 'search_queue'
+    ''').fetchone()
+    if i:
+        return False
+
+    env.sql(SearchQueue.table)
+    env.db.commit()
+    return True
+
+
+def migrate_lang(env):
+    i = env.sql('''
+    SELECT 1 FROM information_schema.columns
+    WHERE table_name = 'bodies' AND column_name = 'lang'
+    ''').fetchone()
+    if i:
+        return False
+
+    env.sql('ALTER TABLE bodies ADD COLUMN lang varchar[]')
+    env.db.commit()
+    return True
+
+
+def migrate_contacts(env):
+    i = env.sql('''
+    SELECT 1 FROM information_schema.tables WHERE table_name = 'contacts'
+    ''').fetchone()
+    if i:
+        return False
+
+    env.sql(Contacts.table)
+    env.sql(EmailContacts.table)
+    env.contacts.link()
+    env.db.commit()
+    return True
+
+
+def migrate_contacts_version(env):
+    i = env.sql('''
+    SELECT 1 FROM information_schema.columns
+    WHERE table_name = 'contacts' AND column_name = 'version'
+    ''').fetchone()
+    if i:
+        return False
+
+    env.sql('ALTER TABLE contacts ADD COLUMN version bigint')
+    env.sql(create_seq('contacts', 'version'))
+    env.sql("UPDATE contacts SET version=nextval('seq_contacts_version')")
+    env.sql(create_index('contacts', 'version'))
+    env.db.commit()
+    return True
+
+
+def migrate_subj_norm(env):
+    from .filters import normalize_subj, hash_participants
+
+    i = env.sql('''
+    SELECT 1 FROM information_schema.columns
+    WHERE table_name = 'emails' AND column_name = 'subj_norm'
+    ''').fetchone()
+    if i:
+        return False
+
+    env.sql('''
+    ALTER TABLE emails
+        ADD COLUMN subj_norm varchar,
+        ADD COLUMN participants varchar;
+    ''')
+    # Server side cursor in the same transaction, as table is locked
+    cur = env.db.cursor('migrate_subj_norm')
+    cur.execute('SELECT id, subj, fr, "to", cc FROM emails')
+    while True:
+        rows = cur.fetchmany(1000)
+        if not rows:
+            break
+        env.emails.update_many([{
+            'id': id,
+            'subj_norm': normalize_subj(subj),
+            'participants': hash_participants(fr, to, cc),
+        } for id, subj, fr, to, cc in rows])
+    cur.close()
+    env.sql('''
+    CREATE INDEX ix_emails_participants ON emails (participants, subj_norm)
+    ''')
+    env.db.commit()
+    return True
+
+
+def migrate_preview(env):
+    from .filters import get_preview
+
+    i = env.sql('''
+    SELECT 1 FROM information_schema.columns
+    WHERE table_name = 'emails' AND column_name = 'preview'
+    ''').fetchone()
+    if i:
+        return False
+
+    env.sql('ALTER TABLE emails ADD COLUMN preview varchar')
+    # Server side cursor in the same transaction, as table is locked
+    cur = env.db.cursor('migrate_preview')
+    cur.execute('SELECT id, text, attachments FROM bodies')
+    while True:
+        rows = cur.fetchmany(1000)
+        if not rows:
+            break
+        env.emails.update_many([{
+            'id': id,
+            'preview': get_preview(text, attachments or []),
+        } for id, text, attachments in rows])
+    cur.close()
+    env.db.commit()
+    return True
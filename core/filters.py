@@ -1,5 +1,7 @@
 import datetime as dt
 import re
+from email.utils import parseaddr
+from functools import lru_cache
 from hashlib import md5
 from urllib.parse import urlencode
 
@@ -8,11 +10,19 @@ import rapidjson as json
 from werkzeug.utils import secure_filename
 from unidecode import unidecode
 
+# Prefixes like "Re: ", "Fwd: ", "RE[2]: "
+re_subj_prefix = re.compile(r'(?i)^(\w{2,3}(\[\d*\])?:\ ?)+')
+# The same prefixes mixed with tags of mailing lists like "[list] "
+re_subj_tags = re.compile(r'^((\w{2,3}(\[\d*\])?:|\[[^\]]*\])\s*)+')
+
+
+def hash_email(addr):
+    return md5(addr.strip().lower().encode()).hexdigest()
+
 
 def get_gravatar(addr, size=75, default='identicon'):
     params = urlencode((('d', default), ('s', size)))
-    hash = md5(addr.strip().lower().encode()).hexdigest()
-    return '//www.gravatar.com/avatar/%s?%s' % (hash, params)
+    return '//www.gravatar.com/avatar/%s?%s' % (hash_email(addr), params)
 
 
 def localize_dt(env, value):
@@ -52,34 +62,69 @@ def is_subj_changed(subj, base):
     return subj != base
 
 
+@lru_cache(maxsize=1024)
+def subj_prefix(base):
+    if not base:
+        return re_subj_prefix
+    # Prefixes are removed only if base subject follows them
+    return re.compile(re_subj_prefix.pattern + '(?=%s)' % re.escape(base))
+
+
 def humanize_subj(subj, base=None, empty='(no subject)'):
     base = base and humanize_subj(base, None, None)
     subj = subj and subj.strip()
-    pattern = r'(?i)^(\w{2,3}(\[\d*\])?:\ ?)+' + (
-        '(?=%s)' % re.escape(base) if base else ''
-    )
-    subj = subj and re.sub(pattern, '', subj)
+    subj = subj and subj_prefix(base).sub('', subj)
     return subj or empty
 
 
-def humanize_html(htm, parents=None, class_='email-quote'):
+def normalize_subj(subj):
+    subj = re_subj_tags.sub('', subj.strip()) if subj else ''
+    return re.sub(r'\s+', ' ', subj).lower()
+
+
+def hash_participants(*fields):
+    addrs = sorted({parseaddr(a)[1].lower() for f in fields for a in f})
+    return md5(','.join(addrs).encode()).hexdigest() if addrs else ''
+
+
+def humanize_html(htm, quotes=None, class_='email-quote'):
     htm = re.sub(r'(<br[ ]?[/]?>\s*)$', '', htm).strip()
-    if htm and parents:
-        htm = hide_quote(htm, parents, class_)
+    if htm and quotes:
+        htm = hide_quote(htm, quotes, class_)
     return htm
 
 
-def hide_quote(msg, msgs, class_):
-    if not msg or not msgs:
+def quote_text(element):
+    text = element.text_content()
+    text = re.sub('[^\w]+', '', text)
+    return text.rstrip()
+
+
+def hash_quote(text):
+    if not text:
+        return ''
+    return '%s:%s' % (len(text), md5(text.encode()).hexdigest())
+
+
+def get_quote(htm):
+    """Fingerprint of message, which is used to find it quoted in replies"""
+    if isinstance(htm, str):
+        if not htm.strip():
+            return ''
+        htm = lh.fromstring(htm)
+    return hash_quote(quote_text(htm))
+
+
+def hide_quote(msg, quotes, class_):
+    quotes = [q for q in quotes if q]
+    if not msg or not quotes:
         return msg
 
     lmsg = lh.fromstring(msg)
-    msgs = [m for m in msgs if m]
 
-    def clean(element):
-        text = element.text_content()
-        text = re.sub('[^\w]+', '', text)
-        return text.rstrip()
+    def is_quoted(text, quote):
+        size = int(quote.split(':', 1)[0])
+        return len(text) >= size and hash_quote(text[-size:]) == quote
 
     def toggle(block):
         block.attrib['class'] = class_
@@ -89,30 +134,30 @@ def hide_quote(msg, msgs, class_):
         parent.insert(parent.index(block), toggle)
         return lh.tostring(lmsg, encoding='utf8').decode()
 
-    for m in msgs:
-        cp = clean(lh.fromstring(m))
-        for block in lmsg.xpath('//blockquote'):
-            cb = clean(block)
-            if cp and cb and cb.endswith(cp):
-                return toggle(block)
-
-        tokens = re.findall('-{3,20}[ \w]*-{3,20}', msg)
-        if not tokens:
-            continue
-
-        s = '(%s)' % '|'.join("//*[contains(text(),'%s')]" % t for t in tokens)
+    quoted = [(b, quote_text(b)) for b in lmsg.xpath('//blockquote')]
+    tokens = re.findall('-{3,20}[ \w]*-{3,20}', msg)
+    if tokens:
+        s = '(%s)' % '|'.join(
+            "//*[contains(text(),'%s')]" % t for t in tokens
+        )
         for block in lmsg.xpath(s):
             blocks = [block] + [b for b in block.itersiblings()]
-            cb = ''.join(clean(b) for b in blocks)
-            if cp and cb and cb.endswith(cp):
-                div = lh.Element('div')
+            quoted.append((blocks, ''.join(quote_text(b) for b in blocks)))
+
+    for quote in quotes:
+        for block, text in quoted:
+            if not text or not is_quoted(text, quote):
+                continue
+
+            if isinstance(block, list):
+                blocks, block = block, lh.Element('div')
                 parent = blocks[0].getparent()
                 index = parent.index(blocks[0])
                 for b in blocks:
                     parent.remove(b)
-                    div.append(b)
-                parent.insert(index, div)
-                return toggle(div)
+                    block.append(b)
+                parent.insert(index, block)
+            return toggle(block)
 
     return msg
 
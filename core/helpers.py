@@ -2,6 +2,7 @@ import hashlib
 import os
 import time
 import signal
+from collections import OrderedDict
 from contextlib import ContextDecorator, contextmanager
 
 from . import log
@@ -76,3 +77,37 @@ class Timer(ContextDecorator):
         if reset:
             self.reset()
         return duration
+
+
+class LRU():
+    """Mapping of limited size, least recently used keys go first"""
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = self.misses = 0
+
+    def get(self, key, default=None):
+        try:
+            value = self.data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        self.data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self.data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'ratio': round(self.hits / total, 3) if total else None,
+        }
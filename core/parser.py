@@ -1,16 +1,26 @@
+import binascii
+import codecs
 import datetime as dt
 import email
 import email.header
+import email.message
 import html
+import os
 import re
+import uuid
 from collections import OrderedDict
+from email.parser import BytesHeaderParser
 
 import chardet
 from lxml import html as lh
 from lxml.html.clean import Cleaner
+from werkzeug.utils import cached_property
 
 from . import log
-from .filters import slugify
+from .filters import get_quote, slugify
+
+# Increase on changes in parsing output to drop cached results
+VERSION = 2
 
 
 def get_charset(name):
@@ -38,33 +48,86 @@ def guess_charsets(text, extra=None):
     return [c for c in charsets if c]
 
 
-def decode_str(text, charset, msg_id=None):
+def get_domain(msg):
+    addr = email.utils.parseaddr(str(msg.get('from', '')))[1]
+    domain = addr.rpartition('@')[2].lower()
+    return domain if re.match(r'^[a-z0-9.-]+\.[a-z0-9-]+$', domain) else None
+
+
+class Context:
+    """Per-message state of parsing, so parser is safe to use in threads"""
+    def __init__(
+        self, msg_id=None, text=None, charset=None,
+        domain=None, charsets=None
+    ):
+        self.msg_id = msg_id
+        self.text = text
+        self.charset = charset
+        self.domain = domain
+        # Charsets learned by sender domain (db.Charsets), optional
+        self.charsets = charsets
+        # Detected charsets are voted once per message
+        self.voted = set()
+
+    @cached_property
+    def detected(self):
+        if self.text is None:
+            return []
+        return guess_charsets(self.text[:4096], self.charset)
+
+    def iter_charsets(self, charset):
+        if charset:
+            yield 'declared', charset
+            return
+
+        # Strict UTF-8 (so ASCII too) rarely succeeds by accident
+        yield 'utf8', 'utf8'
+        if self.domain and self.charsets is not None:
+            learned = self.charsets.get(self.domain)
+            if learned:
+                yield 'domain', learned
+        for charset in self.detected:
+            yield 'detect', charset
+
+    def found(self, path, charset):
+        if self.charsets is None:
+            return
+
+        self.charsets.stats[path] += 1
+        if not self.domain:
+            return
+
+        charset = codecs.lookup(get_charset(charset)).name
+        if path == 'declared' and charset not in ('utf-8', 'ascii'):
+            # Declared charset is the best evidence, even over learned one
+            self.charsets.learn(self.domain, charset)
+        elif path == 'detect' and charset not in self.voted:
+            # Single-byte charsets decode anything, so one guess isn't enough
+            self.voted.add(charset)
+            self.charsets.vote(self.domain, charset)
+
+
+def decode_str(text, charset, ctx=None):
     if not text:
         return ''
 
-    def guess_charsets():
-        guess = getattr(decode_str, 'guess_charsets')
-        if guess:
-            return guess()
-        return ['utf8']
-
+    ctx = ctx or Context()
     charset = get_charset(charset)
-    charsets = [charset] if charset else guess_charsets()
-    for charset_ in charsets:
+    for path, charset_ in ctx.iter_charsets(charset):
         try:
             part = text.decode(get_charset(charset_))
-            break
         except UnicodeDecodeError:
-            part = None
+            continue
+        ctx.found(path, charset_)
+        return part
 
-    if not part:
-        charset_ = charsets[0]
-        log.debug('UnicodeDecodeError(%s) -- %s', charset_, msg_id)
-        part = text.decode(charset_, 'ignore')
-    return part
+    charset_ = charset or (ctx.detected + ['utf8'])[0]
+    ctx.found('fallback', charset_)
+    log.debug('UnicodeDecodeError(%s) -- %s', charset_, ctx.msg_id)
+    return text.decode(get_charset(charset_), 'ignore')
 
 
-def decode_header(text, msg_id):
+def decode_header(text, ctx):
     if not text:
         return ''
 
@@ -73,7 +136,7 @@ def decode_header(text, msg_id):
         if isinstance(text, str):
             part = text
         else:
-            part = decode_str(text, charset, msg_id=msg_id)
+            part = decode_str(text, charset, ctx)
         parts += [part]
 
     header = ''.join(parts)
@@ -81,8 +144,8 @@ def decode_header(text, msg_id):
     return header
 
 
-def decode_addresses(text, msg_id):
-    text = decode_header(text, msg_id)
+def decode_addresses(text, ctx):
+    text = decode_header(text, ctx)
     return [(name, addr) for name, addr in email.utils.getaddresses([text])]
 
 
@@ -92,19 +155,21 @@ def decode_date(text, *args):
     return tm
 
 
+html_cleaner = Cleaner(
+    links=False,
+    safe_attrs_only=False,
+    kill_tags=['head', 'style'],
+    remove_tags=['html', 'base']
+)
+
+
 def clean_html(htm):
     htm = re.sub(r'^\s*<\?xml.*?\?>', '', htm).strip()
     if not htm:
-        return ''
+        return None
 
-    cleaner = Cleaner(
-        links=False,
-        safe_attrs_only=False,
-        kill_tags=['head', 'style'],
-        remove_tags=['html', 'base']
-    )
     htm = lh.fromstring(htm)
-    htm = cleaner.clean_html(htm)
+    html_cleaner(htm)
 
     body = htm.xpath('//body')
     if body:
@@ -115,15 +180,161 @@ def clean_html(htm):
             style = re.sub('(?<!min-)height:100%', 'min-height: 100%', style)
             body[0].attrib['style'] = style
         body[0].tag = 'div'
-    return lh.tostring(htm, encoding='utf-8').decode()
+    return htm
+
+
+def build_html(pieces):
+    if len(pieces) > 1:
+        # Each part is a separate document, so clean them one by one first
+        pieces = (clean_html(p) for p in pieces)
+        pieces = [
+            lh.tostring(p, encoding='utf-8').decode()
+            for p in pieces if p is not None
+        ]
+    return clean_html(''.join(pieces))
+
+
+class Part(email.message.Message):
+    """Message part with offsets of payload in raw message"""
+    chunk_size = 64 * 1024
+    raw, start, end, children = b'', 0, 0, None
+
+    def is_multipart(self):
+        return self.children is not None
+
+    def get_payload(self, i=None, decode=False):
+        if self.is_multipart():
+            return self.children if i is None else self.children[i]
+        elif decode:
+            return b''.join(self.iter_payload())
+        return self.raw[self.start:self.end].decode('ascii', 'surrogateescape')
+
+    def iter_payload(self):
+        cte = str(self.get('content-transfer-encoding', '')).lower().strip()
+        if cte in ('x-uuencode', 'uuencode', 'uue', 'x-uue'):
+            # Rare enough to use standard parser
+            msg = email.message.Message()
+            msg['Content-Transfer-Encoding'] = cte
+            msg.set_payload(self.get_payload())
+            yield msg.get_payload(decode=True)
+            return
+
+        rest, pos = b'', self.start
+        while pos < self.end:
+            stop = min(pos + self.chunk_size, self.end)
+            if stop < self.end and cte == 'quoted-printable':
+                # Only whole lines, to keep escapes and soft breaks intact
+                newline = self.raw.rfind(b'\n', pos, stop)
+                if newline == -1:
+                    newline = self.raw.find(b'\n', stop, self.end)
+                stop = newline + 1 if newline != -1 else self.end
+            chunk, pos = self.raw[pos:stop], stop
+
+            if cte == 'base64':
+                chunk = rest + re.sub(rb'[^A-Za-z0-9+/=]', b'', chunk)
+                size = len(chunk) // 4 * 4
+                chunk, rest = chunk[:size], chunk[size:]
+                yield decode_base64(chunk)
+            elif cte == 'quoted-printable':
+                yield binascii.a2b_qp(chunk)
+            else:
+                yield chunk
+
+        if rest:
+            yield decode_base64(rest + b'=' * (-len(rest) % 4))
+
+
+def decode_base64(data):
+    try:
+        return binascii.a2b_base64(data)
+    except binascii.Error:
+        return b''
+
+
+re_headers_end = re.compile(rb'\r?\n\r?\n')
+
+
+def parse_tree(raw, start=0, end=None, default_type='text/plain'):
+    end = len(raw) if end is None else end
+    if raw.startswith((b'\n', b'\r\n'), start, end):
+        # No headers
+        body = raw.index(b'\n', start) + 1
+    else:
+        body = re_headers_end.search(raw, start, end)
+        body = body.end() if body else end
+
+    part = BytesHeaderParser(_class=Part).parsebytes(raw[start:body])
+    rest = email.message.Message.get_payload(part)
+    if rest:
+        # Headers ended on the line without colon; one char is one byte
+        body -= len(rest)
+    part.set_default_type(default_type)
+    part.raw, part.start, part.end = raw, body, end
+
+    ctype = part.get_content_type()
+    if ctype == 'message/delivery-status':
+        part.children = []
+    elif part.get_content_maintype() == 'message':
+        part.children = [parse_tree(raw, body, end)]
+    elif part.get_content_maintype() == 'multipart' and part.get_boundary():
+        boundary = part.get_boundary().encode('ascii', 'surrogateescape')
+        boundary = re.compile(
+            rb'(?m)^--' + re.escape(boundary) + rb'(--)?[ \t]*\r?$'
+        )
+        default_type = (
+            'message/rfc822' if ctype == 'multipart/digest' else 'text/plain'
+        )
+
+        def add_child(stop):
+            # Line break before boundary belongs to the boundary
+            stop -= raw.startswith(b'\n', stop - 1, stop)
+            stop -= raw.startswith(b'\r', stop - 1, stop)
+            children.append(parse_tree(raw, pos, max(pos, stop), default_type))
+
+        children, pos = [], None
+        for match in boundary.finditer(raw, body, end):
+            if pos is not None and pos < match.start():
+                add_child(match.start())
+            if match.group(1):
+                if pos is None:
+                    # No start boundary, the payload is the preamble
+                    part.end = match.start()
+                break
+            pos = min(match.end() + 1, end)
+        else:
+            if pos is not None:
+                # No close boundary, so the last part takes the rest
+                add_child(end)
+
+        if pos is not None:
+            part.children = children
+    return part
+
+
+def save_part(env, path, part):
+    chunks = part.iter_payload()
+    first = next((c for c in chunks if c), None)
+    if first is None:
+        return False
 
+    if env.files.path(path).exists():
+        return True
 
-def parse_part(env, part, msg_id, inner=False):
+    tmp = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+    with env.files.open(tmp, 'bw') as f:
+        f.write(first)
+        for chunk in chunks:
+            f.write(chunk)
+    os.rename(str(env.files.path(tmp)), str(env.files.path(path)))
+    return True
+
+
+def parse_part(env, part, ctx, inner=False):
     content = OrderedDict([
         ('files', []),
         ('attachments', []),
         ('embedded', {}),
-        ('html', '')
+        ('html', [])
     ])
 
     ctype = part.get_content_type()
@@ -131,10 +342,9 @@ def parse_part(env, part, msg_id, inner=False):
     stype = part.get_content_subtype()
     if part.is_multipart():
         for m in part.get_payload():
-            child = parse_part(env, m, msg_id, True)
-            child_html = child.pop('html', '')
+            child = parse_part(env, m, ctx, True)
+            child_html = [h for h in child.pop('html', []) if h.strip()]
             child_text = child.pop('text', '')
-            content.setdefault('html', '')
             content.setdefault('text', '')
             if stype != 'alternative':
                 content['html'] += child_html
@@ -146,55 +356,53 @@ def parse_part(env, part, msg_id, inner=False):
             content.update(child)
     elif mtype == 'multipart':
         text = part.get_payload(decode=True)
-        text = decode_str(text, part.get_content_charset(), msg_id=msg_id)
-        content['html'] = text
+        text = decode_str(text, part.get_content_charset(), ctx)
+        content['html'] = [text]
     elif ctype in ['text/html', 'text/plain']:
         text = part.get_payload(decode=True)
-        text = decode_str(text, part.get_content_charset(), msg_id=msg_id)
+        text = decode_str(text, part.get_content_charset(), ctx)
         if ctype == 'text/html':
-            content['html'] = text
-        elif ctype == 'text/plain' and not content['html']:
+            content['html'] = [text]
+        elif ctype == 'text/plain':
             text = html.unescape(text)
             text = re.sub(r'<[^>]+>', '', text)
             content['text'] = text
-            text = text2html(text)
-            content['html'] = text
+            content['html'] = [text2html(text)]
     else:
-        payload = part.get_payload(decode=True)
         filename = part.get_filename()
-        filename = decode_header(filename, msg_id) if filename else ctype
+        filename = decode_header(filename, ctx) if filename else ctype
         attachment = {
             'mimetype': ctype,
             'id': part.get('Content-ID'),
             'filename': filename,
-            'payload': payload,
-            'size': len(payload) if payload else None
+            'part': part,
         }
         content['files'] += [attachment]
 
-    content['html'] = clean_html(content['html'])
     if inner:
         return content
 
     content.update(attachments=[], embedded={})
     for index, item in enumerate(content['files']):
-        if item['payload']:
-            name = slugify(item['filename'] or item['id'])
-            path = '/'.join([slugify(msg_id), str(index), name])
-            asset = env.files.to_db(path, item['mimetype'], item['filename'])
-            if item['id']:
-                content['embedded'][item['id']] = asset
-            elif item['filename']:
-                content['attachments'].append(asset)
-            else:
-                log.warn('UnknownAttachment(%s)', msg_id)
-                continue
-
-            env.files.write(path, item['payload'])
-
-    if content['html']:
-        htm = lh.fromstring(content['html'])
+        if not item['id'] and not item['filename']:
+            log.warn('UnknownAttachment(%s)', ctx.msg_id)
+            continue
+
+        name = slugify(item['filename'] or item['id'])
+        path = '/'.join([slugify(ctx.msg_id), str(index), name])
+        if not save_part(env, path, item['part']):
+            continue
+
+        asset = env.files.to_db(path, item['mimetype'], item['filename'])
+        if item['id']:
+            content['embedded'][item['id']] = asset
+        else:
+            content['attachments'].append(asset)
 
+    htm = build_html(content['html'])
+    content['html'] = ''
+    content['quote'] = ''
+    if htm is not None:
         # Fix img[@src]
         embedded = dict(content['embedded'])
         for img in htm.xpath('//img[@src]'):
@@ -210,8 +418,8 @@ def parse_part(env, part, msg_id, inner=False):
         content['attachments'] += embedded.values()
 
         content['html'] = lh.tostring(htm, encoding='utf-8').decode()
-        if 'text' not in content or not content['text']:
-            htm = Cleaner(links=False, style=True).clean_html(htm)
+        content['quote'] = get_quote(htm)
+        if not content.get('text'):
             text = '\n'.join(htm.xpath('//text()'))
             content['text'] = text.strip()
 
@@ -219,12 +427,7 @@ def parse_part(env, part, msg_id, inner=False):
     return content
 
 
-def parse(env, text, msg_id=None):
-    msg = email.message_from_bytes(text)
-    charset = [c for c in msg.get_charsets() if c]
-    charset = charset[0] if charset else None
-    decode_str.guess_charsets = lambda: guess_charsets(text[:4096], charset)
-
+def decode_headers(msg, ctx):
     decoders = {
         'subject': decode_header,
         'from': decode_addresses,
@@ -241,14 +444,35 @@ def parse(env, text, msg_id=None):
     data = {}
     for key, decode in decoders.items():
         value = msg.get(key)
-        data[key] = decode(value, msg_id) if value else None
+        data[key] = decode(value, ctx) if value else None
+    return data
+
+
+def parse_headers(text, msg_id=None, charsets=None):
+    msg = BytesHeaderParser().parsebytes(text)
+    ctx = Context(
+        msg_id, text, msg.get_content_charset(), get_domain(msg), charsets
+    )
+
+    data = decode_headers(msg, ctx)
+    data.update(attachments=[], embedded={}, html='', text='', quote='')
+    return data
+
+
+def parse(env, text, msg_id=None):
+    msg = parse_tree(text)
+    charset = [c for c in msg.get_charsets() if c]
+    charset = charset[0] if charset else None
+    ctx = Context(msg_id, text, charset, get_domain(msg), env.charsets)
 
-    msg_id = str(msg_id or data['message-id'])
-    files = parse_part(env, msg, msg_id)
+    data = decode_headers(msg, ctx)
+    ctx.msg_id = str(msg_id or data['message-id'])
+    files = parse_part(env, msg, ctx)
     data['attachments'] = files['attachments']
     data['embedded'] = files['embedded']
     data['html'] = files.get('html', None)
     data['text'] = files.get('text', None)
+    data['quote'] = files['quote']
     return data
 
 
@@ -2,15 +2,15 @@ import re
 import time
 import uuid
 from contextlib import contextmanager
-from email.utils import parseaddr
 from multiprocessing import Pool
 from multiprocessing.dummy import Pool as ThreadPool
 
 import psycopg2
 import rapidjson as json
 import requests
+from psycopg2 import errorcodes
 
-from . import imap_utf7, parser, log
+from . import filters, imap_utf7, parser, log
 from .helpers import Timer, with_lock
 from .imap import Client
 
@@ -109,7 +109,7 @@ def map_ids(env, imap, uids):
     return exists, new
 
 
-def get_parsed(env, data, msgid=None):
+def get_parsed(env, data, msgid=None, headers_only=False):
     def format_addr(v):
         if not v[0]:
             v = (v[1].split('@')[0], v[1])
@@ -148,9 +148,22 @@ def get_parsed(env, data, msgid=None):
         ('text', 'text'),
         ('attachments', 'attachments'),
         ('embedded', 'embedded'),
+        ('quote', 'quote'),
     )
-    msg = parser.parse(env, data, msgid)
+    if headers_only:
+        msg = parser.parse_headers(data, msgid, env.charsets)
+    else:
+        msg = parser.parse(env, data, msgid)
     parsed = dict((field, clean(field, msg[key])) for key, field in pairs)
+    parsed['subj_norm'] = filters.normalize_subj(parsed['subj'])
+    parsed['preview'] = filters.get_preview(msg['text'], msg['attachments'])
+    parsed['participants'] = filters.hash_participants(
+        parsed['fr'], parsed['to'], parsed['cc']
+    )
+    parsed['parser_version'] = None if headers_only else parser.VERSION
+    parsed['lang'] = None if headers_only else detect_langs(
+        env, '%s\n%s' % (parsed['subj'] or '', parsed['text'] or '')
+    )
     if parsed['in_reply_to'] and not parsed['refs']:
         parsed['refs'] = [parsed['in_reply_to']]
     elif not parsed['in_reply_to'] and parsed['refs']:
@@ -158,6 +171,49 @@ def get_parsed(env, data, msgid=None):
     return parsed
 
 
+# Environment of worker process, see "pool_init"
+pool_env = None
+
+
+def pool_init(username, conf):
+    from . import Env
+
+    global pool_env
+    pool_env = Env(username, conf)
+
+
+def pool_parse(item):
+    id, raw = item
+    stats = pool_env.charsets.stats
+    stats.clear()
+    row = dict(get_parsed(pool_env, raw, id), id=id)
+    return row, dict(stats)
+
+
+# Scripts of letters with related search configurations
+SCRIPTS = (
+    ('english', re.compile('[a-zA-Z]')),
+    ('russian', re.compile('[а-яА-ЯёЁ]')),
+)
+
+
+def detect_langs(env, text):
+    # The first one is for scripts without own configuration
+    langs, default = [], env('search_lang')[0]
+
+    text = text[:10000]
+    counts = [(lang, len(regex.findall(text))) for lang, regex in SCRIPTS]
+    total = sum(count for lang, count in counts)
+    for lang, count in counts:
+        if not count or count < total * 0.1:
+            continue
+
+        lang = lang if lang in env('search_lang') else default
+        if lang not in langs:
+            langs.append(lang)
+    return langs or [default]
+
+
 def fetch_headers(env, imap, uids):
     if not uids:
         log.info('  * No headers to fetch')
@@ -166,9 +222,15 @@ def fetch_headers(env, imap, uids):
     ids = []
     q = ['INTERNALDATE', 'RFC822.SIZE', 'RFC822.HEADER', 'X-GM-MSGID']
     for data in imap.fetch_batch(uids, q, 'add emails with headers'):
-        for uid, row in data:
+        data = list(data)
+        i = env.sql('''
+        SELECT nextval('seq_emails_id') FROM generate_series(1, %s)
+        ''', [len(data)])
+        new_ids = [r[0] for r in i]
+
+        rows = []
+        for (uid, row), id in zip(data, new_ids):
             extid = row['X-GM-MSGID']
-            id = env.sql("SELECT nextval('seq_emails_id')").fetchone()[0]
             fields = {
                 'id': id,
                 'header': row['RFC822.HEADER'],
@@ -178,25 +240,69 @@ def fetch_headers(env, imap, uids):
                 'delid': uuid.uuid5(
                     uuid.NAMESPACE_URL, '%s\r%s' % (imap.email, extid)
                 ),
+                'duplicate': None,
             }
-            fields.update(get_parsed(env, fields['header'], id))
-            try:
-                id = env.emails.insert(fields)
-            except psycopg2.IntegrityError:
-                env.db.rollback()
-                ref = env.sql('''
-                SELECT id FROM emails WHERE msgid=%s
-                ''', [fields['msgid']]).fetchone()[0]
-                del fields['msgid']
-                fields['duplicate'] = ref
-                id = env.emails.insert(fields)
-                env.db.commit()
-            else:
-                env.db.commit()
-                ids.append((uid, id[0]))
+            fields.update(get_parsed(env, fields['header'], id, True))
+            rows.append((uid, fields))
+
+        i = env.sql('''
+        SELECT msgid, id FROM emails WHERE msgid = ANY(%s::varchar[])
+        ''', [[f['msgid'] for uid, f in rows if f['msgid']]])
+        msgids = dict(i)
+        for uid, fields in rows:
+            msgid = fields['msgid']
+            if msgid in msgids:
+                fields.update(msgid=None, duplicate=msgids[msgid])
+            elif msgid:
+                msgids[msgid] = fields['id']
+
+        try:
+            insert_emails(env, [f for uid, f in rows])
+        except psycopg2.IntegrityError as e:
+            if e.pgcode != errorcodes.UNIQUE_VIOLATION:
+                raise
+            # Concurrent sync inserted some of these, so go one by one
+            env.db.rollback()
+            log.warn('  ! %s, insert one by one', e.diag.message_primary)
+            rows = [(uid, f) for uid, f in rows if insert_email(env, f)]
+        env.db.commit()
+        ids += [(uid, f['id']) for uid, f in rows if not f['duplicate']]
     return ids
 
 
+def split_email(env, row):
+    fields = set(env.bodies.field_names) - {env.bodies.pk}
+    body = {k: v for k, v in row.items() if k in fields}
+    email = {k: v for k, v in row.items() if k not in fields}
+    return email, body
+
+
+def insert_email(env, row):
+    i = env.sql('SELECT id FROM emails WHERE extid = %s', [row['extid']])
+    if i.fetchone():
+        # Already inserted
+        return False
+
+    if row['msgid']:
+        i = env.sql('SELECT id FROM emails WHERE msgid = %s', [row['msgid']])
+        ref = i.fetchone()
+        if ref:
+            row.update(msgid=None, duplicate=ref[0])
+    insert_emails(env, [row])
+    return True
+
+
+def insert_emails(env, rows):
+    emails, bodies = [], []
+    for row in rows:
+        email, body = split_email(env, row)
+        emails.append(email)
+        bodies.append(dict(body, id=email['id']))
+    env.emails.copy(emails)
+    env.bodies.copy(bodies)
+    env.contacts.link([e['id'] for e in emails])
+
+
 @contextmanager
 def async_runner(count=0, threads=True):
     if count:
@@ -221,7 +327,7 @@ def async_runner(count=0, threads=True):
 
 def fetch_bodies(env, imap, uid2id):
     i = env.sql('''
-    SELECT id, size FROM emails
+    SELECT id, size FROM emails JOIN bodies USING (id)
     WHERE id = ANY(%(ids)s) AND raw IS NULL
     ''', {'ids': list(uid2id.values())})
     pairs = dict(i)
@@ -234,10 +340,11 @@ def fetch_bodies(env, imap, uid2id):
     results = []
 
     def update(env, items):
-        ids = []
-        for data, id in items:
-            data_ = dict(get_parsed(env, data, id), raw=data)
-            ids += update_email(env, data_, 'id=%s', [id])
+        rows = [
+            dict(get_parsed(env, data, id), raw=data, id=id)
+            for data, id in items
+        ]
+        ids = update_emails(env, rows)
 
         env.db.commit()
         notify(env, ids)
@@ -250,31 +357,61 @@ def fetch_bodies(env, imap, uid2id):
             run(update, env, items)
 
     log.info('  * Done %s bodies', sum(results))
+    log.info('  * Charsets: %s', dict(env.charsets.stats))
 
 
-def update_email(env, row, where, params):
-    doc = []
-    for lang in env('search_lang'):
-        people = sum((row[key] for key in ['fr', 'to', 'cc', 'bcc']), [])
-        doc.append(
-            env.mogrify('''
-            setweight(to_tsvector(%(lang)s, %(subj)s), 'A') ||
-            setweight(to_tsvector(%(lang)s, %(text)s), 'C') ||
-            setweight(to_tsvector(%(lang)s, %(people)s), 'D') ||
-            setweight(to_tsvector(%(lang)s, %(files)s), 'D')
-            ''', {
-                'lang': lang,
-                'subj': row['subj'],
-                'text': row['text'],
-                'people': '\\n'.join(people),
-                'files': json.dumps(row['attachments'])
-            })
-        )
+def update_emails(env, rows):
+    emails, bodies = [], []
+    for row in rows:
+        email, body = split_email(env, row)
+        emails.append(email)
+        bodies.append(dict(body, id=email['id']))
+
+    ids = env.emails.update_many(emails)
+    if not ids:
+        return ids
+
+    ids_ = set(ids)
+    env.bodies.update_many([b for b in bodies if b['id'] in ids_])
+    env.contacts.link(ids)
+    # Search vectors are built later by "index_search"
+    env.search_queue.push(ids)
+    return ids
 
-    doc = ' || '.join(doc)
-    where = env.mogrify(where, params)
-    env.sql('UPDATE emails SET search=({}) WHERE {}'.format(doc, where))
-    return env.emails.update(row, where)
+
+def index_search(env, limit=1000):
+    rows = env.search_queue.pop(limit)
+    if not rows:
+        return 0
+
+    # Emails parsed before detection of language get all of them
+    langs = env.mogrify(
+        'coalesce(b.lang, %s::varchar[])', [env('search_lang')]
+    )
+    search = ' || '.join(
+        '''
+        coalesce(
+            setweight(to_tsvector({lang}, coalesce(e.subj, '')), 'A') ||
+            setweight(to_tsvector({lang}, coalesce(b.text, '')), 'C') ||
+            setweight(to_tsvector({lang}, array_to_string(
+                e.fr || e."to" || e.cc || e.bcc, E'\\n'
+            )), 'D') ||
+            setweight(to_tsvector(
+                {lang}, coalesce(b.attachments::text, '')
+            ), 'D'),
+            ''
+        )
+        '''.format(lang='(%s)[%s]::regconfig' % (langs, num))
+        for num in range(1, len(env('search_lang')) + 1)
+    )
+    env.sql('''
+    UPDATE bodies b SET search=({search})
+    FROM emails e
+    WHERE b.id = e.id AND b.id = ANY(%s::bigint[])
+    '''.format(search=search), [list({r['id'] for r in rows})])
+    # Commits the whole batch
+    env.storage.set('search_indexed', max(r['seq'] for r in rows))
+    return len(rows)
 
 
 def fetch_labels(env, imap, uid2id, folder, clean=True):
@@ -321,6 +458,7 @@ def fetch_labels(env, imap, uid2id, folder, clean=True):
 def clean_labels(env, labels, folder):
     labels |= {'\\Answered', '\\Unread', folder}
     labels = [imap_utf7.decode(l) for l in labels]
+    labels = env.labels.get_ids(labels)
 
     # Sorted array intersection
     new_labels = env.mogrify('''
@@ -328,18 +466,18 @@ def clean_labels(env, labels, folder):
       SELECT i FROM (
         SELECT unnest(labels)
         INTERSECT
-        SELECT unnest(%s)
+        SELECT unnest(%s::int[])
       ) AS dt(i)
       ORDER BY 1
     )
     ''', [labels])
     sql = '''
-    UPDATE emails SET labels=({0}), thrid=NULL
+    UPDATE emails SET labels=({0}), thrid=NULL, {1}
     WHERE (SELECT ARRAY(SELECT unnest(labels) ORDER BY 1)) != ({0})
-    AND %s = ANY(labels)
+    AND labels @> ARRAY[%s]
     RETURNING id
-    '''.format(new_labels)
-    i = env.sql(sql, [folder])
+    '''.format(new_labels, env.emails.touch)
+    i = env.sql(sql, [env.labels.get_id(folder)])
     log.info('  * Clean %d emails', i.rowcount)
     return tuple(r[0] for r in i)
 
@@ -373,15 +511,15 @@ def mark(env, action, name, ids, **opts):
     actions = {
         '-': (
             '''
-            UPDATE emails SET labels = array_remove(labels, %(name)s)
-            WHERE id IN %(ids)s AND %(name)s=ANY(labels)
+            UPDATE emails SET labels = array_remove(labels, %(label)s), {touch}
+            WHERE id IN %(ids)s AND labels @> ARRAY[%(label)s]
             RETURNING id
             '''
         ),
         '+': (
             '''
-            UPDATE emails SET labels = (labels || %(name)s::varchar)
-            WHERE id IN %(ids)s AND NOT(%(name)s=ANY(labels))
+            UPDATE emails SET labels = (labels || %(label)s::int), {touch}
+            WHERE id IN %(ids)s AND NOT(labels @> ARRAY[%(label)s])
             RETURNING id
             '''
         ),
@@ -409,11 +547,18 @@ def mark(env, action, name, ids, **opts):
                 continue
             mark(env, *row, ids=ids, inner=True, commit=commit)
 
-    i = env.sql(actions[action], {'name': name, 'ids': ids})
+    label = env.labels.get_id(name, create=action == '+')
+    sql = actions[action].format(touch=env.emails.touch)
+    i = env.sql(sql, {'label': label, 'ids': ids})
     updated = [r[0] for r in i]
     if new:
-        env.emails.update({'thrid': None}, 'id IN %s', [ids])
-        updated += update_thrids(env, commit=False)
+        # Only folders and manual threads take part in threading
+        threading = (
+            name in FOLDERS or name.startswith(THRID) or
+            (action, name) == ('+', '\\Inbox')
+        )
+        if threading and opts.get('rethread', True):
+            updated += rethread(env, ids, commit=False)
 
         env.add_tasks([{'action': action, 'name': name, 'ids': ids}])
         if commit:
@@ -477,7 +622,8 @@ def notify(env, ids, last_sync=False):
     d = json.dumps({
         'notify': True,
         'ids': list(set(ids)),
-        'last_sync': last_sync
+        'last_sync': last_sync,
+        'version': env.emails.version()
     })
     try:
         requests.post(url, data=d, timeout=5, auth=(env.username, env.token))
@@ -488,38 +634,46 @@ def notify(env, ids, last_sync=False):
 def update_label(env, gids, label, folder=None, clean=True):
     def step(action, sql):
         t = Timer()
-        sql += (
-            ('  AND %(folder)s = ANY(labels)' if folder else '') +
+        sql = sql.format(touch=env.emails.touch) + (
+            ('  AND labels @> ARRAY[%(folder)s]' if folder else '') +
             'RETURNING id'
         )
-        i = env.sql(sql, {'label': label, 'gids': gids, 'folder': folder})
+        i = env.sql(sql, params)
         log.info('  - %s %d emails for %.2fs', action, i.rowcount, t.time())
         step.ids += tuple(r[0] for r in i)
     step.ids = ()
+    params = {
+        'label': env.labels.get_id(label, create=True),
+        'folder': folder and env.labels.get_id(folder),
+        'gids': gids
+    }
 
     log.info('  * Process %r...', label)
     if clean:
         step('remove from', '''
-        UPDATE emails SET thrid=NULL, labels=array_remove(labels, %(label)s)
-        WHERE NOT (id = ANY(%(gids)s)) AND %(label)s = ANY(labels)
+        UPDATE emails
+        SET thrid=NULL, labels=array_remove(labels, %(label)s), {touch}
+        WHERE NOT (id = ANY(%(gids)s)) AND labels @> ARRAY[%(label)s]
         ''')
 
     step('add to', '''
-    UPDATE emails SET thrid=NULL, labels=(labels || %(label)s::varchar)
-    WHERE id = ANY(%(gids)s) AND NOT (%(label)s = ANY(labels))
+    UPDATE emails SET thrid=NULL, labels=(labels || %(label)s::int), {touch}
+    WHERE id = ANY(%(gids)s) AND NOT (labels @> ARRAY[%(label)s])
     ''')
     return step.ids
 
 
-def update_thrids(env, folder=None, manual=True, commit=True):
+def update_thrids(env, folder=None, manual=True, commit=True, ids=None):
     where = (
-        env.mogrify('%s = ANY(labels)', [folder])
+        env.mogrify('labels @> ARRAY[%s]', [env.labels.get_id(folder)])
         if folder else
-        env.mogrify('labels && %s::varchar[]', [list(FOLDERS)])
+        env.mogrify('labels && %s::int[]', [env.labels.get_ids(FOLDERS)])
     )
+    if ids is not None:
+        where += env.mogrify(' AND id = ANY(%s::bigint[])', [list(ids)])
     emails = env.sql('''
     SELECT
-        id, fr, sender, "to", cc, subj, labels,
+        id, fr, "to", subj_norm, participants, labels,
         array_prepend(in_reply_to, refs) AS refs
     FROM emails WHERE thrid IS NULL AND {where} ORDER BY id
     '''.format(where=where)).fetchall()
@@ -531,26 +685,37 @@ def update_thrids(env, folder=None, manual=True, commit=True):
         return condition
 
     t, updated = Timer(), []
+    # Thread ids are written in one statement at the end, so parents
+    # from the same batch are looked up here first
+    thrids = {}
+
+    def found(parent):
+        nonlocal thrid, pid
+        thrid = thrid or thrids.get(parent['id'], parent['thrid'])
+        pid = pid or parent['id']
+
     for row in emails:
         thrid = pid = None
 
         refs = [r for r in row['refs'] if r]
-        ctx = {'folder': folder or (set(FOLDERS) & set(row['labels'])).pop()}
+        labels = env.labels.get_names(row['labels'])
+        ctx = {'folder': folder or (set(FOLDERS) & set(labels)).pop()}
+        ctx['folder'] = env.labels.get_id(ctx['folder'])
 
-        m_label = [l for l in row['labels'] if l.startswith('%s/' % THRID)]
+        m_label = [l for l in labels if l.startswith('%s/' % THRID)]
         if manual and m_label:
             # Manual thread
             extid = m_label.pop().replace('%s/' % THRID, '')
             thrid = env.sql('''
             SELECT id FROM emails
-            WHERE extid=%(extid)s AND %(folder)s = ANY(labels)
+            WHERE extid=%(extid)s AND labels @> ARRAY[%(folder)s]
             ''', dict(ctx, extid=extid)).fetchone()
             if thrid:
                 thrid = thrid[0]
 
         if yet(row['fr'][0].endswith('<mailer-daemon@googlemail.com>')):
             # Failed delivery
-            text = env.sql('SELECT text FROM emails WHERE id=%s', [row['id']])
+            text = env.sql('SELECT text FROM bodies WHERE id=%s', [row['id']])
             text = text.fetchone()[0]
             msgid = re.search('(?m)^Message-ID:(.*)$', text)
             if msgid:
@@ -558,20 +723,19 @@ def update_thrids(env, folder=None, manual=True, commit=True):
                 parent = env.sql('''
                 SELECT id, thrid FROM emails
                 WHERE
-                    %(folder)s = ANY(labels)
+                    labels @> ARRAY[%(folder)s]
                     AND msgid=%(msgid)s
                 ORDER BY id DESC
                 LIMIT 1
                 ''', dict(ctx, msgid=msgid)).fetchone()
                 if parent:
-                    thrid = thrid or parent['thrid']
-                    pid = pid or parent['id']
+                    found(parent)
 
         if yet(refs):
             parent = env.sql('''
             SELECT id, thrid FROM emails
             WHERE
-                %(folder)s = ANY(labels)
+                labels @> ARRAY[%(folder)s]
                 AND msgid = %(ref)s
             ORDER BY id DESC
             LIMIT 1
@@ -580,57 +744,81 @@ def update_thrids(env, folder=None, manual=True, commit=True):
                 parent = env.sql('''
                 SELECT id, thrid FROM emails
                 WHERE
-                    %(folder)s = ANY(labels)
+                    labels @> ARRAY[%(folder)s]
                     AND (in_reply_to || refs) && %(refs)s::varchar[]
                 ORDER BY id DESC
                 LIMIT 1
                 ''', dict(ctx, refs=refs)).fetchone()
             if parent:
-                thrid = thrid or parent['thrid']
-                pid = pid or parent['id']
+                found(parent)
 
-        if yet(row['fr'] and row['to']):
-            fr = row['sender'][0] if row['sender'] else row['fr'][0]
-            fr = parseaddr(fr)[1]
+        if yet(row['fr'] and row['to'] and row['participants']):
+            # The same subject between the same people
             parent = env.sql('''
             SELECT id, thrid FROM emails
             WHERE
-              %(folder)s = ANY(labels)
+              labels @> ARRAY[%(folder)s]
               AND id < %(id)s
-              AND subj LIKE %(subj)s
-              AND array_to_string(sender || fr || "to" || cc, ',') LIKE %(fr)s
-              AND (sender || fr || "to" || cc) && %(to)s::varchar[]
+              AND participants = %(participants)s
+              AND subj_norm = %(subj_norm)s
             ORDER BY id DESC
             LIMIT 1
             ''', dict(ctx, **{
-                'subj': '%{}'.format(row['subj']) if row['subj'] else '',
-                'fr': '%<{}>%'.format(fr),
-                'to': row['to'] + row['cc'],
+                'participants': row['participants'],
+                'subj_norm': row['subj_norm'],
                 'id': row['id'],
             })).fetchone()
             if parent:
-                thrid = thrid or parent['thrid']
-                pid = pid or parent['id']
+                found(parent)
 
-        updates = {
-            'thrid': thrid if thrid else row['id'],
+        thrids[row['id']] = thrid if thrid else row['id']
+        updated.append({
+            'id': row['id'],
+            'thrid': thrids[row['id']],
             'parent': pid
-        }
-        env.emails.update(updates, 'id=%s', [row['id']])
-        updated.append(row['id'])
+        })
 
-    if updated:
+    updated = env.emails.update_many(updated)
+    if commit:
         env.db.commit()
+    if updated:
         log.info('  - for %.2fs', t.time())
     return updated
 
 
+def rethread(env, ids, manual=True, commit=True):
+    '''Update thread ids only for given emails and related ones
+
+    Related are replies (by Message-ID and References) and emails threaded
+    under given ones, recursively. Other emails aren't scanned.
+    '''
+    if not ids:
+        return []
+
+    i = env.sql('''
+    WITH RECURSIVE related(id, msgid) AS (
+        SELECT id, msgid FROM emails WHERE id = ANY(%s::bigint[])
+      UNION
+        SELECT e.id, e.msgid FROM related r
+        JOIN emails e ON
+            e.in_reply_to = r.msgid
+            OR e.refs @> ARRAY[r.msgid]
+            OR e.thrid = r.id
+    )
+    UPDATE emails SET thrid = NULL
+    WHERE id IN (SELECT id FROM related)
+    RETURNING id
+    ''', [list(ids)])
+    ids = [r[0] for r in i]
+    return update_thrids(env, manual=manual, commit=commit, ids=ids)
+
+
 def failed_delivery(env, folder):
     emails = env.sql('''
-    SELECT id, text FROM emails
-    WHERE fr[1] LIKE '%%<mailer-daemon@googlemail.com>' AND %s = ANY(labels)
+    SELECT id, text FROM emails JOIN bodies USING (id)
+    WHERE fr[1] LIKE '%%<mailer-daemon@googlemail.com>' AND labels @> ARRAY[%s]
     ORDER BY id
-    ''', [folder])
+    ''', [env.labels.get_id(folder)])
     ids = []
     for msg in emails:
         msgid = re.search('(?m)^Message-ID:(.*)$', msg['text'])
@@ -644,11 +832,12 @@ def failed_delivery(env, folder):
         if not thrid:
             continue
 
-        i = env.sql('''
-        UPDATE emails SET thrid=%(thrid)s
+        sql = '''
+        UPDATE emails SET thrid=%(thrid)s, {touch}
         WHERE (id=%(id)s OR thrid=%(id)s) AND thrid!=%(thrid)s
         RETURNING id
-        ''', {'thrid': thrid[0][0], 'id': msg['id']})
+        '''.format(touch=env.emails.touch)
+        i = env.sql(sql, {'thrid': thrid[0][0], 'id': msg['id']})
         ids += [r['id'] for r in i]
 
     log.info('  - merge threads by failed delivery: %s', ids)
@@ -663,10 +852,11 @@ def clean_thrid(env, ids):
     ''', [list(ids)])
 
     for row in i:
-        label = row[0]
-        if not label.startswith('%s/' % THRID):
+        label = env.labels.get_name(row[0])
+        if not label or not label.startswith('%s/' % THRID):
             continue
-        mark(env, '-', label, row[1], new=True, commit=False)
+        # Callers update thread ids afterwards
+        mark(env, '-', label, row[1], new=True, commit=False, rethread=False)
 
 
 def mark_thread(env, thrid, ids):
@@ -681,15 +871,17 @@ def new_thread(env, id):
 
     parent_ids = env.emails.update({'thrid': None}, 'thrid = %s', [thrid])
     env.emails.update({'thrid': id}, 'id = %s', [id])
-    update_thrids(env, manual=False, commit=False)
+    update_thrids(env, manual=False, commit=False, ids=parent_ids)
 
     i = env.sql('SELECT id FROM emails WHERE thrid=%s', [id])
     ids = [r[0] for r in i]
     mark_thread(env, extid, ids)
 
-    parent_ids = tuple(set(parent_ids) - set(ids))
-    env.emails.update({'thrid': None}, 'thrid IN %s', [parent_ids])
-    update_thrids(env, manual=True, commit=True)
+    parent_ids = list(set(parent_ids) - set(ids))
+    parent_ids = env.emails.update(
+        {'thrid': None}, 'thrid = ANY(%s::bigint[])', [parent_ids]
+    )
+    update_thrids(env, manual=True, commit=True, ids=parent_ids)
 
 
 def merge_threads(env, ids):
@@ -1,4 +1,6 @@
+import calendar
 import functools as ft
+import hashlib
 import re
 from email.utils import parseaddr
 
@@ -27,7 +29,8 @@ rules = [
     Rule('/compose/new/', endpoint='compose'),
     Rule('/compose/<id>/', endpoint='compose'),
     Rule('/draft/<thrid>/<action>/', endpoint='draft'),
-    Rule('/search-email/', endpoint='search_email')
+    Rule('/search-email/', endpoint='search_email'),
+    Rule('/changes/', endpoint='changes')
 ]
 url_map = Map(rules)
 
@@ -80,6 +83,33 @@ def login_required(func):
     return ft.wraps(func)(inner)
 
 
+def with_etag(func):
+    def inner(env, *a, **kw):
+        # Emails get new version on every change by syncer or "mark",
+        # storage keeps drafts, settings and so on
+        version = env.sql('''
+        SELECT
+            (SELECT max(version) FROM emails),
+            (SELECT max(updated) FROM storage),
+            (SELECT count(*) FROM storage)
+        ''').fetchone()
+        etag = hashlib.md5(repr((
+            env.username,
+            env.request.full_path,
+            env.session.get('tz_offset'),
+            tuple(version),
+        )).encode()).hexdigest()
+        if env.request.if_none_match.contains_weak(etag):
+            response = env.make_response(status=304)
+        else:
+            response = func(env, *a, **kw)
+            if not isinstance(response, env.Response):
+                response = env.to_json(response)
+        response.set_etag(etag, weak=True)
+        return response
+    return ft.wraps(func)(inner)
+
+
 def adapt_page():
     def inner(env, *a, **kw):
         schema = v.parse({
@@ -142,18 +172,19 @@ def info(env):
 
 
 @login_required
+@with_etag
 def labels(env):
     # TODO: count message from thread without particular label
-    i = env.sql('''
-    WITH labels(name) AS (SELECT DISTINCT unnest(labels) FROM emails)
-    SELECT l.name, count(e.id) AS unread FROM labels l
-    LEFT JOIN emails e ON l.name = ANY(labels)
-        AND ARRAY['\\Unread', '\\All']::varchar[] <@ labels
-    GROUP BY l.name
-    ''')
+    i = env.sql_prepared('labels', '''
+    WITH ids(id) AS (SELECT DISTINCT unnest(labels) FROM emails)
+    SELECT ids.id, count(e.id) AS unread FROM ids
+    LEFT JOIN emails e ON e.labels @> (ids.id || $1)
+    GROUP BY ids.id
+    ''', [env.labels.get_ids(['\\Unread', '\\All'])], ['int[]'], explain=True)
+    labels = ((env.labels.get_name(l['id']), l['unread']) for l in i)
     labels = (
-        dict(l, url=url_query(env, 'in', l['name']))
-        for l in i if not l['name'].startswith('%s/' % syncer.THRID)
+        {'name': n, 'unread': c, 'url': url_query(env, 'in', n)}
+        for n, c in labels if n and not n.startswith('%s/' % syncer.THRID)
     )
     zero = ['\\Pinned', '\\All', syncer.THRID]
     labels = (dict(l, unread=0) if l['name'] in zero else l for l in labels)
@@ -168,7 +199,8 @@ def ctx_init(env):
         'username': env.username,
         'email': env.email,
         'image': env.email and f.get_gravatar(env.email),
-        'last_sync': last_sync
+        'last_sync': last_sync,
+        'version': env.emails.version()
     }
 
 
@@ -195,15 +227,19 @@ def parse_query(env, query, page=None):
             elif name == 'subj':
                 value = value.strip('"')
                 sql = 'subj LIKE %s'
-            elif name == 'from':
-                value = '%<{}>%'.format(value)
-                sql = "array_to_string(fr, ',') LIKE %s"
-            elif name == 'to':
-                value = '%<{}>%'.format(value)
-                sql = "array_to_string(\"to\" || cc, ',') LIKE %s"
-            elif name == 'email':
-                value = '%<{}>%'.format(value)
-                sql = "array_to_string(\"to\" || cc || fr, ',') LIKE %s"
+            elif name in ('from', 'to', 'email'):
+                value = value.lower()
+                sql = (
+                    'id IN ('
+                    'SELECT l.id FROM email_contacts l'
+                    ' JOIN contacts c ON c.id = l.contact_id'
+                    ' WHERE c.addr = %s AND l.field IN ({})'
+                    ')'
+                ).format({
+                    'from': "'fr'",
+                    'to': "'to', 'cc'",
+                    'email': "'to', 'cc', 'fr'",
+                }[name])
             elif name == 'msgid':
                 value = value.strip()
                 sql = "msgid = %s"
@@ -235,7 +271,7 @@ def parse_query(env, query, page=None):
     q = re.sub(pattern, replace, query)
     q = re.sub('[ ]+', ' ', q)
 
-    fields = 'id'
+    fields, tables = 'id', 'emails'
     if q.strip():
         tsq = []
         for lang in env('search_lang'):
@@ -246,6 +282,7 @@ def parse_query(env, query, page=None):
         tsq = ' || '.join(tsq)
         where.append('search @@ (%s)' % tsq)
         fields = 'id, ts_rank(search, %s) AS sort' % tsq
+        tables = 'emails JOIN bodies USING (id)'
         ctx['order_by'] = 'sort'
 
     labels = set(ctx['labels'])
@@ -254,7 +291,11 @@ def parse_query(env, query, page=None):
         else labels | {'\\All'}
     )
     ctx['labels'] = labels
-    where.append(env.mogrify('labels @> %s::varchar[]', [labels]))
+    label_ids = env.labels.get_ids(labels)
+    if not where and not (page and page['last']):
+        # Query by labels only, so threads use prepared statements
+        ctx['label_ids'] = label_ids
+    where.append(env.mogrify('labels @> %s::int[]', [label_ids]))
 
     if page and page['last']:
         where.append(env.mogrify('created < %s', [page['last']]))
@@ -262,11 +303,14 @@ def parse_query(env, query, page=None):
 
     where = ' AND '.join(where)
     where = ('WHERE %s' % where) if where else ''
-    sql = 'SELECT {} FROM emails {}'.format(fields, where)
+    sql = 'SELECT {} FROM {} {}'.format(fields, tables, where)
     return sql, ctx
 
 
 def ctx_emails(env, items, threads=False):
+    if env.request.args.get('compact'):
+        return ctx_compact(env, items)
+
     emails, last = [], None
     for i in items:
         extra = i.get('_extra', {})
@@ -276,7 +320,7 @@ def ctx_emails(env, items, threads=False):
             'subj': i['subj'],
             'subj_human': f.humanize_subj(i['subj']),
             'subj_url': url_query(env, 'subj', i['subj']),
-            'preview': f.get_preview(i['text'], i['attachments']),
+            'preview': i['preview'],
             'body': False,
             'pinned': '\\Pinned' in i['labels'],
             'unread': '\\Unread' in i['labels'],
@@ -307,6 +351,61 @@ def ctx_emails(env, items, threads=False):
     return {'emails': emails}
 
 
+def ctx_compact(env, items):
+    # Response for "?compact=1": no URLs, client builds them by ids;
+    # people and labels are indexes in "contacts" and "label_names"
+    contacts, names = {}, {}
+
+    def person(contact):
+        return contacts.setdefault(contact, len(contacts))
+
+    def label(name):
+        return names.setdefault(name, len(names))
+
+    emails, last = [], None
+    for i in items:
+        extra = dict(i.get('_extra', {}))
+        labels = extra.pop('labels', None)
+        if labels is None:
+            labels = ctx_labels(env, i['labels'])
+        email = dict({
+            'id': i['id'],
+            'thrid': i['thrid'],
+            'subj': i['subj'],
+            'subj_human': f.humanize_subj(i['subj']),
+            'preview': i['preview'],
+            'body': False,
+            'pinned': '\\Pinned' in i['labels'],
+            'unread': '\\Unread' in i['labels'],
+            'draft': '\\Draft' in i['labels'],
+            'time': calendar.timegm(i['time'].timetuple()),
+            'fr': person(i['fr'][0]),
+            'to': [person(v) for v in i['to']],
+            'cc': [person(v) for v in i['cc']],
+            'labels': [label(l) for l in labels or []],
+        }, **extra)
+
+        last = i['created'] if not last or i['created'] > last else last
+        emails.append(email)
+
+    contacts = (parseaddr(c) for c in sorted(contacts, key=contacts.get))
+    contacts = [
+        {'name': name, 'email': email, 'hash': f.hash_email(email)}
+        for name, email in contacts
+    ]
+
+    emails = bool(emails) and {
+        'items': emails,
+        'length': len(emails),
+        'last': str(last)
+    }
+    return {
+        'emails': emails,
+        'contacts': contacts,
+        'label_names': sorted(names, key=names.get),
+    }
+
+
 def ctx_links(env, id, thrid=None, to=None):
     reply_url = env.url_for('compose', {'id': id})
     return {
@@ -320,15 +419,20 @@ def ctx_links(env, id, thrid=None, to=None):
 
 
 def ctx_person(env, contact):
-    name, email = parseaddr(contact)
-    return {
-        'full': contact,
-        'short': name if env('ui_use_names') else email,
-        'name': name,
-        'email': email,
-        'url': url_query(env, 'email', email),
-        'image': f.get_gravatar(email),
-    }
+    key = (contact, env('ui_use_names'))
+    person = env.persons.get(key)
+    if person is None:
+        name, email = parseaddr(contact)
+        person = {
+            'full': contact,
+            'short': name if env('ui_use_names') else email,
+            'name': name,
+            'email': email,
+            'url': url_query(env, 'email', email),
+            'image': f.get_gravatar(email),
+        }
+        env.persons.set(key, person)
+    return person
 
 
 def ctx_labels(env, labels, ignore=None, all=True):
@@ -351,7 +455,7 @@ def ctx_labels(env, labels, ignore=None, all=True):
 
 def ctx_all_labels(env):
     i = env.sql('SELECT DISTINCT unnest(labels) FROM emails')
-    items = (r[0] for r in i.fetchall())
+    items = env.labels.get_names(r[0] for r in i.fetchall())
     items = set(items) | set(syncer.FOLDERS)
     return ctx_labels(env, sorted(items))
 
@@ -359,8 +463,10 @@ def ctx_all_labels(env):
 def ctx_body(env, msg, msgs, show=False):
     if msgs and not isinstance(msgs[0], str):
         msgs = (
-            m['html'] for m in msgs
-            if msg['parent'] and m['id'] <= msg['parent']
+            # Quote is NULL for emails parsed before it was added
+            m['quote'] if m['quote'] is not None else
+            f.get_quote(m['html'] or '')
+            for m in msgs if msg['parent'] and m['id'] <= msg['parent']
         )
     if not show and '\\Unread' not in msg['labels']:
         return False
@@ -388,48 +494,53 @@ def ctx_quote(env, msg, forward=False):
 
 
 @login_required
+@with_etag
 def thread(env, id):
-    where = env.mogrify('FROM emails WHERE thrid = %s', [id])
-    i = env.sql('SELECT count(id), json_agg(labels) %s' % where)
-    count, labels = i.fetchone()
+    count, labels, subj = env.sql_prepared('thread_info', '''
+    SELECT count(id), json_agg(labels), (array_agg(subj ORDER BY id))[1]
+    FROM emails WHERE thrid = $1
+    ''', [id], ['bigint'], explain=True).fetchone()
     if count:
-        labels = set(sum((r for r in labels), []))
-        subj = env.sql('SELECT subj %s ORDER BY id' % where).fetchone()[0]
+        labels = env.labels.get_names(set(sum((r for r in labels), [])))
+        name, where, param = 'thread', 'thrid = $1', (id, 'bigint')
         if not env.request.args.get('full'):
-            i = env.sql('''
+            i = env.sql_prepared('thread_few', '''
             SELECT id FROM emails WHERE id IN (
               SELECT id FROM emails
-                WHERE thrid = %(thrid)s
+                WHERE thrid = $1
                 ORDER BY id LIMIT 1
             ) OR id IN (
               SELECT id FROM emails
-                WHERE thrid = %(thrid)s
-                ORDER BY id DESC LIMIT %(few)s
+                WHERE thrid = $1
+                ORDER BY id DESC LIMIT $3
             ) OR id IN (
               SELECT id FROM emails
-                WHERE labels && %(labels)s::varchar[] AND thrid = %(thrid)s
+                WHERE labels && $2 AND thrid = $1
             )
-            ''', {
-                'thrid': id,
-                'labels': ['\\Unread', '\\Pinned'],
-                'few': env('ui_thread_few')
-            })
+            ''', [
+                id,
+                env.labels.get_ids(['\\Unread', '\\Pinned']),
+                env('ui_thread_few')
+            ], ['bigint', 'int[]', 'int'], explain=True)
             ids = [r[0] for r in i]
             if (count - len(ids)) > env('ui_thread_few'):
-                where = env.mogrify('FROM emails WHERE id = ANY(%s)', [ids])
+                name, where = 'thread_ids', 'id = ANY($1)'
+                param = (ids, 'bigint[]')
 
-        i = env.sql('''
+        i = env.sql_prepared(name, '''
         SELECT
-            id, thrid, subj, labels, time, fr, "to", text, cc, created,
-            html, attachments, parent
-        {where}
+            id, thrid, subj, labels, time, fr, "to", cc, created, preview,
+            html, quote, attachments, parent
+        FROM emails JOIN bodies USING (id)
+        WHERE {where}
         ORDER BY id
-        '''.format(where=where))
+        '''.format(where=where), [param[0]], [param[1]], explain=True)
         msgs = []
 
         def emails():
             for msg in i:
                 msg = dict(msg)
+                msg['labels'] = env.labels.get_names(msg['labels'])
                 msg['_extra'] = {
                     'subj_changed': f.is_subj_changed(msg['subj'], subj),
                     'subj_human': f.humanize_subj(msg['subj'], subj),
@@ -456,12 +567,16 @@ def thread(env, id):
 
 
 @login_required
+@with_etag
 @adapt_page()
 def emails(env, page):
     schema = v.parse({'q': v.Nullable(str, '')})
     q = schema.validate(env.request.args)['q']
     ctx = {'labels': ['\\All']}
+    # Token for "changes", taken before the query, so nothing is missed
+    version = env.emails.version()
     if q.startswith('g! '):
+        version = None
         # Gmail search
         ids = syncer.search(env, env.email, q[3:])
         select_ids = env.mogrify('''
@@ -474,18 +589,83 @@ def emails(env, page):
     res = threads(env, select_ids, ctx, page)
     res['labels'] = ctx_labels(env, ctx['labels'])
     res['search_query'] = q
+    res['version'] = version
     return res
 
 
-def threads(env, select_ids, ctx, page):
+@login_required
+def changes(env):
+    schema = v.parse({'+since': v.AdaptTo(int), 'q': v.Nullable(str, '')})
+    args = schema.validate(env.request.args)
+
+    version = env.emails.version()
+    i = env.sql('''
+    SELECT DISTINCT thrid FROM emails
+    WHERE version > %s AND thrid IS NOT NULL
+    ''', [args['since']])
+    thrids = [r[0] for r in i]
+    if len(thrids) > env('ui_per_page') or args['since'] > version:
+        # Too much is changed, so client should load the page again
+        return {'version': version, 'reload': True}
+
+    res = {'version': version, 'emails': False, 'removed': []}
+    if thrids:
+        select_ids, ctx = parse_query(env, args['q'])
+        select_ids = '(%s AND %s) AS ids' % (
+            select_ids, env.mogrify('thrid = ANY(%s::bigint[])', [thrids])
+        )
+        # Query isn't by labels only anymore
+        ctx.pop('label_ids', None)
+        page = {'limit': len(thrids), 'offset': 0, 'count': len(thrids)}
+        ctx = threads(env, select_ids, ctx, page)
+        # Emails with "contacts" and "label_names" for compact mode
+        res.update(
+            (k, v) for k, v in ctx.items()
+            if k not in ('count', 'threads', 'next')
+        )
+        items = res['emails']['items'] if res['emails'] else []
+        found = {e['thrid'] for e in items}
+        # Threads don't match the query anymore
+        res['removed'] = sorted(set(thrids) - found)
+
     i = env.sql('''
-    SELECT count(distinct thrid) FROM emails e JOIN {} ON e.id = ids.id
-    '''.format(select_ids))
+    SELECT unnest(labels), count(id) FROM emails
+    WHERE labels @> %s::int[] GROUP BY 1
+    ''', [env.labels.get_ids(['\\Unread', '\\All'])])
+    zero = ['\\Pinned', '\\All', syncer.THRID]
+    res['unread'] = {
+        n: c for n, c in ((env.labels.get_name(l), c) for l, c in i)
+        if n and n not in zero and not n.startswith('%s/' % syncer.THRID)
+    }
+    return res
+
+
+def threads(env, select_ids, ctx, page):
+    label_ids = ctx.get('label_ids')
+
+    def sql(name, query):
+        if label_ids is None:
+            return env.sql(query.format(
+                select_ids=select_ids,
+                limit=page['limit'],
+                offset=page['offset']
+            ))
+        params = [label_ids, page['limit'], page['offset']]
+        return env.sql_prepared(name, query.format(
+            select_ids='(SELECT id FROM emails WHERE labels @> $1) AS ids',
+            limit='$2',
+            offset='$3'
+        ), params, ['int[]', 'int', 'int'], explain=True)
+
+    i = sql('threads_count', '''
+    SELECT count(distinct thrid)
+    FROM emails e JOIN {select_ids} ON e.id = ids.id
+    ''')
     count = i.fetchone()[0]
 
     # Use ts_rank when fulltext search
     # order_by = ctx.get('order_by', 'id')
-    i = env.sql('''
+    i = sql('threads', '''
     WITH
     thread_ids AS (
         SELECT thrid
@@ -505,20 +685,16 @@ def threads(env, select_ids, ctx, page):
         JOIN emails e ON e.thrid = t.thrid
         GROUP BY t.thrid
         ORDER BY 1 DESC
-        LIMIT {page[limit]} OFFSET {page[offset]}
+        LIMIT {limit} OFFSET {offset}
     )
     SELECT
-        id, t.thrid, subj, t.labels, time, fr, text, "to", cc, created,
-        attachments, count, subj_list
+        e.id, t.thrid, subj, t.labels, time, fr, "to", cc, created,
+        preview, count, subj_list
     FROM threads t
     JOIN emails e ON e.thrid = t.thrid
-    WHERE id IN (SELECT unnest(t.id_list) ORDER BY 1 DESC LIMIT 1)
+    WHERE e.id IN (SELECT unnest(t.id_list) ORDER BY 1 DESC LIMIT 1)
     ORDER BY t.max_id DESC
-    '''.format(
-        select_ids=select_ids,
-        page=page,
-        order_by=ctx.get('order_by', 'id')
-    ))
+    ''')
 
     def emails():
         for msg in i:
@@ -526,7 +702,7 @@ def threads(env, select_ids, ctx, page):
             base_subj = base_subj[sorted(base_subj)[0]]
             msg = dict(msg, **{
                 'labels': list(
-                    set(sum(msg['labels'], [])) -
+                    set(env.labels.get_names(sum(msg['labels'], []))) -
                     (set(ctx['labels']) - {'\\Pinned', '\\Unread'})
                 ),
                 '_extra': {
@@ -553,45 +729,58 @@ def threads(env, select_ids, ctx, page):
 @login_required
 def body(env, id):
     def parse(raw, id):
-        return parser.parse(env, raw.tobytes(), id)
-
-    row = env.sql('''
+        raw = raw.tobytes()
+        key = '%s-%s' % (hashlib.sha1(raw).hexdigest(), parser.VERSION)
+        parsed = env.cache.get(key)
+        if parsed is None:
+            parsed = parser.parse(env, raw, id)
+            parsed = {k: parsed[k] for k in (
+                'html', 'text', 'attachments', 'embedded', 'quote'
+            )}
+            env.cache.set(key, parsed)
+        return parsed
+
+    row = env.sql_prepared('body', '''
     SELECT
-        id, thrid, subj, labels, time, fr, "to", cc, text, created,
+        id, thrid, subj, labels, time, fr, "to", cc, created, preview,
         html, raw, attachments, parent
-    FROM emails WHERE id=%s LIMIT 1
-    ''', [id]).fetchone()
+    FROM emails JOIN bodies USING (id) WHERE id=$1 LIMIT 1
+    ''', [id], ['bigint'], explain=True).fetchone()
     if not row:
         return env.abort(404)
 
-    i = env.sql('''
-    SELECT id, raw, html FROM emails
-    WHERE thrid=%s AND id!=%s AND id<=%s
+    i = env.sql_prepared('body_parents', '''
+    SELECT id, raw, html, quote FROM emails JOIN bodies USING (id)
+    WHERE thrid=$1 AND id!=$2 AND id<=$3
     ORDER BY time DESC
-    ''', [row['thrid'], id, row['parent']])
+    ''', [
+        row['thrid'], id, row['parent']
+    ], ['bigint', 'bigint', 'bigint'], explain=True)
 
     def emails():
         for msg in [row]:
             if not msg['raw']:
                 continue
 
+            msg = dict(msg)
+            msg['labels'] = env.labels.get_names(msg['labels'])
             if env.request.args.get('parse'):
                 parsed = parse(msg['raw'], msg['id'])
-                msg = dict(msg)
                 msg['html'] = (
                     parser.text2html(parsed['text'])
                     if env.request.args.get('text') else
                     parsed['html']
                 )
-                msg['text'] = parsed['text']
+                msg['preview'] = f.get_preview(
+                    parsed['text'], parsed['attachments']
+                )
                 msg['attachments'] = parsed['attachments']
                 msg['embedded'] = parsed['embedded']
                 msgs = [
-                    parse(p['raw'], p['id'])['html']
+                    parse(p['raw'], p['id'])['quote']
                     for p in i if msg['parent'] and p['id'] <= msg['parent']
                 ]
             else:
-                msg = dict(msg)
                 msgs = i.fetchall()
 
             msg['_extra'] = {
@@ -611,7 +800,7 @@ def body(env, id):
 def raw(env, id):
     from tests import open_file
 
-    i = env.sql('SELECT raw, header FROM emails WHERE id=%s LIMIT 1', [id])
+    i = env.sql('SELECT raw, header FROM bodies WHERE id=%s LIMIT 1', [id])
     row = i.fetchone()
     raw = row[0] or row[1]
     if env('debug') and env.request.args.get('save'):
@@ -631,13 +820,28 @@ def mark(env):
     schema = v.parse({
         '+action': v.Enum(('+', '-', '=')),
         '+name': v.AdaptBy(name),
-        '+ids': [int],
+        'ids': [int],
+        'q': v.Nullable(str),
         'old_name': v.AdaptBy(name),
         'thread': v.Nullable(bool, False),
         'last': v.Nullable(str)
     })
     data = schema.validate(env.request.json)
-    if not data['ids']:
+    if data.get('q') is not None:
+        # Everything matching the query is resolved by one statement,
+        # so client doesn't need to page through results for ids
+        select_ids, ctx = parse_query(env, data['q'])
+        column = 'thrid' if data['thread'] else 'id'
+        i = env.sql('''
+        SELECT coalesce(array_agg(id), '{{}}') FROM emails
+        WHERE {column} IN (
+            SELECT e.{column} FROM emails e
+            JOIN ({select_ids}) AS ids ON e.id = ids.id
+        )
+        '''.format(column=column, select_ids=select_ids))
+        data['ids'], data['thread'] = i.fetchone()[0], False
+
+    if not data.get('ids'):
         return 'OK'
 
     ids = tuple(data['ids'])
@@ -697,7 +901,7 @@ def compose(env, id=None):
         SELECT
             thrid, "to", fr, cc, bcc, subj, reply_to, html, time,
             attachments, embedded
-        FROM emails WHERE id=%s LIMIT 1
+        FROM emails JOIN bodies USING (id) WHERE id=%s LIMIT 1
         ''', [id]).fetchone()
         if env.equal_email(parent['fr'][0]):
             to = parent['to']
@@ -916,20 +1120,5 @@ def search_email(env):
     schema = v.parse({'q': str})
     args = schema.validate(env.request.args)
 
-    where = ''
-    if args.get('q'):
-        where += env.mogrify('addr LIKE %s', ['%{}%'.format(args['q'])])
-    where = ('WHERE ' + where) if where else ''
-
-    addresses = env.mogrify('''
-    SELECT distinct unnest("to") AS addr, time
-    FROM emails
-    WHERE fr[1] LIKE %s
-    ''', ['%<{}>'.format(env.email)])
-
-    i = env.sql('''
-    WITH addresses AS ({addresses})
-    SELECT addr, max(time) FROM addresses
-    {where} GROUP BY addr ORDER BY 2 DESC LIMIT 100
-    '''.format(where=where, addresses=addresses))
-    return [{'text': v[0], 'value': v[0]} for v in i if len(v[0]) < 100]
+    addresses = env.addresses.search(args.get('q', ''))
+    return [{'text': v, 'value': v} for v in addresses if len(v) < 100]
@@ -11,6 +11,8 @@ Vue.config.proto = false;
 let array_union = require('lodash/array/union');
 
 let ws, wsTry = 0, handlers = {}, handlerSeq = 0;
+// Last responses with ETags by url, so the same data isn't sent again
+let etags = new Map();
 let user, view, views = [], tab, sidebar, title, history;
 let initUser = (data, url) => {
     user = data.username ? data : null;
@@ -678,6 +680,33 @@ let Emails = Component.extend({
             }
             return data;
         },
+        applyChanges() {
+            let url = `/changes/?since=${this.version}`;
+            url += `&q=${encodeURIComponent(this.search_query)}`;
+            send(url, null, (data) => {
+                if (data.reload) return reload();
+
+                this.version = data.version;
+                let changed = data.emails ? data.emails.items : [];
+                let thrids = new Set(data.removed);
+                for (let email of changed) {
+                    email.vid = email.thrid;
+                    email.checked = this.checked_list.has(email.vid);
+                    thrids.add(email.thrid);
+                }
+                let items = this.emails.items.filter((el) => {
+                    return !thrids.has(el.thrid);
+                });
+                // New threads appear on the first page only
+                let first = !/[?&]page=/.test(getPath());
+                let known = new Set(this.emails.items.map((el) => el.thrid));
+                for (let email of changed) {
+                    if (first || known.has(email.thrid)) items.push(email);
+                }
+                items.sort((a, b) => b.id - a.id);
+                this.emails.items = items;
+            });
+        },
         initReply(url, focus) {
             if (!url) url = this.reply_url;
             if (this.replyView) this.replyView.$destroy();
@@ -1016,7 +1045,17 @@ function connect() {
                 let elapsed = (Date.now() - handler.time) / 1000;
                 console.log(`response for ${data.uid} (${elapsed}s)`);
 
-                parseJson(data.payload)
+                let payload = data.payload;
+                if (data.not_modified) {
+                    payload = handler.cached.payload;
+                } else if (data.etag) {
+                    etags.delete(handler.url);
+                    etags.set(handler.url, {etag: data.etag, payload});
+                    if (etags.size > 20) {
+                        etags.delete(etags.keys().next().value);
+                    }
+                }
+                parseJson(payload)
                     .then(handler.callback.success)
                     .catch(handler.callback.error || (ex => {
                         error([data.uid, ex]);
@@ -1031,6 +1070,9 @@ function connect() {
             if (data.ids.length) {
                 console.log(`Notify: ${data.ids.length} updated`);
                 sidebar.fetch();
+                if (view && view.constructor == Emails && view.version) {
+                    view.applyChanges();
+                }
             }
             if (data.last_sync) {
                 send('/info/', null, (data) => {
@@ -1115,11 +1157,13 @@ function send(url, data, cb, icon) {
     }
 
     if (ws && conf.ws_proxy && ws.readyState === ws.OPEN) {
+        let cached = !data && callback && etags.get(url);
         data = {
             url: url,
             payload: data,
             uid: handlerSeq++,
-            cookie: document.cookie
+            cookie: document.cookie,
+            etag: cached ? cached.etag : null
         };
         console.log(url, data.uid);
         ws.send(JSON.stringify(data));
@@ -1127,7 +1171,8 @@ function send(url, data, cb, icon) {
             handlers[data.uid] = {
                 callback: callback,
                 time: Date.now(),
-                url: url
+                url: url,
+                cached: cached
             };
         }
     } else {
@@ -3,6 +3,7 @@ import argparse
 import functools as ft
 import json
 import logging
+import re
 import subprocess as sp
 from pathlib import Path
 
@@ -200,35 +201,100 @@ sync.choices = ['fast', 'full']
 
 
 @for_all
-def parse(env, limit=1000, offset=0, where=None):
-    from core import syncer
-    from core.helpers import Timer
+def parse(env, limit=1000, where=None, force=False, processes=None):
+    from collections import Counter
+    from multiprocessing import Pool
 
-    where = where or 'raw IS NOT NULL'
+    from core import parser, syncer
+    from core.helpers import Timer
 
-    sql = 'SELECT count(id) FROM emails WHERE {where}'.format(where=where)
-    count = env.sql(sql).fetchone()[0] - offset
-    if count <= 0:
+    where = ' AND '.join('(%s)' % w for w in [
+        'raw IS NOT NULL',
+        not force and (
+            'parser_version IS NULL OR parser_version < %s' % parser.VERSION
+        ),
+        where
+    ] if w)
+    # Newest emails go first, so the last done id is the checkpoint
+    checkpoint = env.storage('parse', where=where)
+    if checkpoint.get():
+        log.info('Continue from id=%s', checkpoint.get())
+        where += ' AND id < %s' % int(checkpoint.get())
+
+    count = env.sql('''
+    SELECT count(id) FROM emails JOIN bodies USING (id) WHERE {where}
+    '''.format(where=where)).fetchone()[0]
+    if not count:
+        checkpoint.rm()
         return
 
     log.info('Parse %s emails for %r', count, env.username)
 
-    timer, done = Timer(), 0
-    for offset in range(offset, count, limit):
-        i = env.sql('''
-        SELECT id FROM emails
+    timer, done, stats = Timer(), 0, Counter()
+
+    def save(results):
+        nonlocal done
+        rows = []
+        for row, row_stats in results:
+            rows.append(row)
+            stats.update(row_stats)
+        syncer.update_emails(env, rows)
+        # Commits updated emails too
+        checkpoint.set(rows[-1]['id'])
+
+        done += len(rows)
+        log.info(
+            '  - done %s of %s, %.0f rows/s',
+            done, count, done / timer.duration
+        )
+
+    pool = Pool(processes, syncer.pool_init, [
+        env.username, env.conf_default
+    ])
+    # Server-side cursor on separate connection, so commits don't close it
+    with pool, env.db_cursor(name='parse') as cur:
+        cur.itersize = limit
+        cur.execute('''
+        SELECT id, raw FROM emails JOIN bodies USING (id)
         WHERE {where}
-        ORDER BY created DESC
-        LIMIT %s OFFSET %s
-        '''.format(where=where), (limit, offset))
-        for row in i:
-            raw = env.sql('SELECT raw FROM emails WHERE id=%s', [row['id']])
-            raw = raw.fetchone()[0].tobytes()
-            data = syncer.get_parsed(env, raw, row['id'])
-            syncer.update_email(env, dict(data), 'id=%s', [row['id']])
-            env.db.commit()
-            done += 1
-        log.info('  - done %s for %.2f', done, timer.duration)
+        ORDER BY id DESC
+        '''.format(where=where))
+
+        pending = None
+        while True:
+            items = [(id, raw.tobytes()) for id, raw in cur.fetchmany(limit)]
+            # Next batch is parsing while previous one is saving
+            task = items and pool.map_async(syncer.pool_parse, items)
+            if pending:
+                save(pending.get())
+            if not task:
+                break
+            pending = task
+
+    checkpoint.rm()
+    log.info('  * Charsets: %s', dict(stats))
+
+
+@for_all
+def index(env, limit=1000):
+    from core import syncer
+    from core.helpers import Timer
+
+    count = env.search_queue.count()
+    if not count:
+        return
+
+    log.info('Index %s emails for %r', count, env.username)
+    timer, done = Timer(), 0
+    while True:
+        indexed = syncer.index_search(env, limit)
+        if not indexed:
+            break
+        done += indexed
+        log.info(
+            '  - done %s, %.0f rows/s, indexed up to seq=%s',
+            done, done / timer.duration, env.storage.get('search_indexed')
+        )
 
 
 @for_all
@@ -238,11 +304,125 @@ def thrids(env, clear=False):
     log.info('Update thread ids for %r', env.username)
     if clear:
         log.info('  * Clear thrids')
-        env.sql('UPDATE emails SET thrid = NULL RETURNING id')
+        env.sql('UPDATE emails SET thrid = NULL, %s' % env.emails.touch)
 
     syncer.update_thrids(env)
 
 
+def bench(env, target, count=1000, repeat=10):
+    from core import syncer
+    from core.helpers import Timer
+
+    def report(name, times, sizes=None):
+        times = sorted(t * 1000 for t in times)
+        log.info(
+            '  * %s: min=%.3fms p50=%.3fms max=%.3fms (%s runs)',
+            name, times[0], times[len(times) // 2], times[-1], len(times)
+        )
+        if sizes:
+            log.info('    size: avg=%.1fKB', sum(sizes) / len(sizes) / 1024)
+
+    def mark():
+        i = env.sql('SELECT id FROM emails ORDER BY id DESC LIMIT %s', [count])
+        ids = [r[0] for r in i]
+        log.info('Bench mark for %s emails of %r', len(ids), env.username)
+
+        timer, times = Timer(), {'+': [], '-': []}
+        for _ in range(repeat):
+            for action in ('+', '-'):
+                timer.reset()
+                syncer.mark(env, action, 'mlr/bench', ids, inner=True)
+                times[action].append(timer.time())
+        # Leave database untouched
+        env.db.rollback()
+        report('add label', times['+'])
+        report('remove label', times['-'])
+
+    def views():
+        from werkzeug.test import EnvironBuilder
+        from core import app, views
+
+        i = env.sql('''
+        SELECT thrid, max(id) FROM emails
+        GROUP BY thrid ORDER BY 2 DESC LIMIT %s
+        ''', [count])
+        rows = i.fetchall()
+        log.info('Bench views for %s threads of %r', len(rows), env.username)
+
+        web = app.WebEnv(views)
+        web.username = env.username
+        urls = (
+            ('labels', [('/labels/', {})]),
+            ('emails', [
+                ('/emails/', {'q': 'in:\\Inbox'}),
+                ('/emails/', {'q': 'in:\\All'}),
+            ]),
+            ('emails compact', [
+                ('/emails/', {'q': 'in:\\Inbox', 'compact': 1}),
+                ('/emails/', {'q': 'in:\\All', 'compact': 1}),
+            ]),
+            ('thread', [('/thread/%s/' % r[0], {}) for r in rows]),
+            ('thread compact', [
+                ('/thread/%s/' % r[0], {'compact': 1}) for r in rows
+            ]),
+            ('body', [('/body/%s/' % r[1], {}) for r in rows]),
+            ('body parsed', [
+                ('/body/%s/' % r[1], {'parse': 1}) for r in rows
+            ]),
+        )
+        timer = Timer()
+        for name, items in urls:
+            times, sizes = [], []
+            for _ in range(repeat):
+                for path, args in items:
+                    builder = EnvironBuilder(path, query_string=args)
+                    web.request = app.Request(builder.get_environ())
+                    web.adapter = web.url_map.bind_to_environ(
+                        web.request.environ
+                    )
+                    timer.reset()
+                    # With encoding to JSON, it's a part of response time
+                    response = web.process_response()
+                    times.append(timer.time())
+                    sizes.append(len(response.get_data()))
+                    web.db.rollback()
+            report(name, times, sizes)
+        log.info('  * persons cache: %s', web.persons.stats())
+
+    def parser():
+        from core import parser
+
+        path = Path(__file__).parent / 'tests' / 'files_parser'
+        headers = [
+            re.split(b'\r?\n\r?\n', p.read_bytes(), 1)[0] + b'\r\n\r\n'
+            for p in sorted(path.glob('*.txt'))
+        ]
+        log.info('Bench parser for %s headers', len(headers))
+
+        timer = Timer()
+        funcs = (
+            ('full parser', lambda h: parser.parse(env, h, 'bench')),
+            ('header parser', lambda h: parser.parse_headers(h, 'bench')),
+        )
+        for name, func in funcs:
+            times = []
+            for _ in range(repeat):
+                for header in headers:
+                    timer.reset()
+                    func(header)
+                    times.append(timer.time())
+            report(name, times)
+
+    targets = {
+        'mark': mark,
+        'views': views,
+        'parser': parser,
+    }
+    return targets[target]()
+
+bench.choices = ['mark', 'views', 'parser']
+
+
 def grun(name, extra):
     extra = '--timeout=300 --graceful-timeout=0 %s' % (extra or '')
     sh(
@@ -287,8 +467,15 @@ def migrate(env, init=False, clean=False):
     log.info('Migrate for %s', env.db_name)
 
     def clean_emails():
+        env.sql('DROP TABLE IF EXISTS search_queue')
+        env.sql('DROP TABLE IF EXISTS email_contacts')
+        env.sql('DROP TABLE IF EXISTS contacts')
+        env.sql('DROP TABLE IF EXISTS bodies')
         env.sql('DROP TABLE IF EXISTS emails')
+        env.sql('DROP TABLE IF EXISTS labels')
         env.sql('DROP SEQUENCE IF EXISTS seq_emails_id')
+        env.sql('DROP SEQUENCE IF EXISTS seq_emails_version')
+        env.sql('DROP SEQUENCE IF EXISTS seq_contacts_version')
         env.storage.rm('last_sync')
         env.db.commit()
 
@@ -297,7 +484,32 @@ def migrate(env, init=False, clean=False):
 
     if clean or init:
         db.init(env)
-    env.username = env.username  # reset db connection
+    else:
+        if db.migrate_labels(env):
+            log.info('  * Labels moved to dictionary')
+        if db.migrate_bodies(env):
+            log.info('  * Bodies moved to separate table')
+        if db.migrate_version(env):
+            log.info('  * Version column added')
+        if db.migrate_charsets(env):
+            log.info('  * Charsets table added')
+        if db.migrate_quote(env):
+            log.info('  * Quote column added, run "parse" to fill it')
+        if db.migrate_parser_version(env):
+            log.info('  * Parser version column added')
+        if db.migrate_search_queue(env):
+            log.info('  * Search queue table added')
+        if db.migrate_lang(env):
+            log.info('  * Lang column added')
+        if db.migrate_contacts(env):
+            log.info('  * Contacts tables added')
+        if db.migrate_contacts_version(env):
+            log.info('  * Contacts version column added')
+        if db.migrate_subj_norm(env):
+            log.info('  * Normalized subject and participants added')
+        if db.migrate_preview(env):
+            log.info('  * Preview column added')
+    env.db_reset()
 
 
 def deploy(opts):
@@ -474,15 +686,30 @@ def get_full(argv):
     cmd('parse')\
         .arg('-u', '--username')\
         .arg('-l', '--limit', type=int, default=1000)\
-        .arg('-o', '--offset', type=int, default=0)\
         .arg('-w', '--where')\
-        .exe(lambda a: parse(Env(a.username), a.limit, a.offset, a.where))
+        .arg('-f', '--force', action='store_true')\
+        .arg('-p', '--processes', type=int)\
+        .exe(lambda a: parse(
+            Env(a.username), a.limit, a.where, a.force, a.processes
+        ))
+
+    cmd('index')\
+        .arg('-u', '--username')\
+        .arg('-l', '--limit', type=int, default=1000)\
+        .exe(lambda a: index(Env(a.username), a.limit))
 
     cmd('thrids')\
         .arg('-u', '--username')\
         .arg('-c', '--clear', action='store_true')\
         .exe(lambda a: thrids(Env(a.username), a.clear))
 
+    cmd('bench')\
+        .arg('target', choices=bench.choices)\
+        .arg('-u', '--username', required=True)\
+        .arg('-c', '--count', type=int, default=1000)\
+        .arg('-r', '--repeat', type=int, default=10)\
+        .exe(lambda a: bench(Env(a.username), a.target, a.count, a.repeat))
+
     cmd('db-init')\
         .arg('username')\
         .arg('-r', '--reset', action='store_true')\
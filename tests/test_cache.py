@@ -0,0 +1,37 @@
+import os
+
+from core import Cache
+from core.helpers import LRU
+
+
+def test_lru(env, tmpdir):
+    env.conf.update(path_cache=str(tmpdir), cache_maxsize=100)
+    cache = Cache(env)
+    assert cache.get('a1') is None
+
+    value = {'html': 'x' * 10}
+    for key in ('a1', 'a2', 'b1'):
+        cache.set(key, value)
+        assert cache.get(key) == value
+    size = cache.size
+    assert size == sum(s for p, s, t in cache.entries())
+
+    # "a1" is used recently, so "a2" is the first to go
+    os.utime(str(cache.path(cache.subpath('a2'))), (0, 0))
+    # Room for three and a half entries
+    cache.maxsize = size // 3 * 3.5
+    cache.set('b2', value)
+    assert cache.get('a2') is None
+    assert [cache.get(k) for k in ('a1', 'b1', 'b2')] == [value] * 3
+    assert cache.size <= cache.maxsize
+
+
+def test_lru_memory():
+    cache = LRU(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert [cache.get(k) for k in ('a', 'c')] == [1, 3]
+    assert cache.stats() == {'size': 2, 'hits': 3, 'misses': 1, 'ratio': 0.75}
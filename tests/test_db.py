@@ -0,0 +1,124 @@
+import datetime as dt
+import uuid
+from unittest.mock import patch
+
+import rapidjson as json
+from pytest import fixture, mark, raises
+
+from core.db import copy_value
+
+
+@fixture
+def env(env):
+    yield env
+    env.db.rollback()
+
+
+@mark.parametrize('value, type_, expected', [
+    (None, None, '\\N'),
+    (None, 'jsonb', '\\N'),
+    (True, None, 't'),
+    (False, None, 'f'),
+    (10, None, '10'),
+    ('a\tb\nc\rd\\e', None, 'a\\tb\\nc\\rd\\\\e'),
+    (b'\x00\xff', None, '\\\\x00ff'),
+    (['a', None, 'b"c', 'd\\e\tf'], None,
+     '{"a",NULL,"b\\\\"c","d\\\\\\\\e\\tf"}'),
+    ([], None, '{}'),
+    ({'a': 'b\n'}, None, '{"a":"b\\\\n"}'),
+    ([{'a': 1}], 'jsonb', '[{"a":1}]'),
+    ('{"a":1}', 'jsonb', '{"a":1}'),
+    (dt.datetime(2017, 1, 2, 3, 4, 5), None, '2017-01-02 03:04:05'),
+])
+def test_copy_value(value, type_, expected):
+    assert copy_value(value, type_) == expected
+
+
+def test_batch(env):
+    weird = 'tab\t, newline\n, backslash\\ "quote" \\N'
+    email = {
+        'id': -1,
+        'delid': uuid.uuid4(),
+        'subj': weird,
+        'refs': ['<a>', weird, None],
+        'labels': [],
+        'time': dt.datetime(2017, 1, 2),
+        'size': None,
+    }
+    assert env.emails.copy(email) == 1
+    assert env.bodies.copy({
+        'id': -1,
+        'raw': b'\x00\\\t\xff',
+        'attachments': [{'name': weird}],
+        'embedded': {'<a>': weird},
+        'lang': ['simple'],
+    }) == 1
+
+    def get(sql):
+        return dict(env.sql(sql + ' WHERE id = -1').fetchone())
+
+    row = get('SELECT subj, refs, labels, time, size FROM emails')
+    assert row == {k: email[k] for k in row}
+    row = get('SELECT raw, attachments, embedded, lang FROM bodies')
+    assert bytes(row['raw']) == b'\x00\\\t\xff'
+    assert row['attachments'] == [{'name': weird}]
+    assert row['embedded'] == {'<a>': weird}
+    assert row['lang'] == ['simple']
+
+    # Parameters are cast by types of columns
+    ids = env.emails.update_many([{
+        'id': -1, 'subj': None, 'refs': [], 'labels': [1, 2], 'size': 10
+    }])
+    assert ids == [-1]
+    row = get('SELECT subj, refs, labels, size, version FROM emails')
+    assert row['version']
+    del row['version']
+    assert row == {'subj': None, 'refs': [], 'labels': [1, 2], 'size': 10}
+
+    env.bodies.update_many([{'id': -1, 'attachments': '[]', 'lang': None}])
+    assert get('SELECT attachments, lang FROM bodies') == {
+        'attachments': [], 'lang': None
+    }
+
+    key = 'test:%s' % uuid.uuid4()
+    assert env.storage.upsert({'key': key, 'value': '{"a": 1}'}) == [key]
+    value = json.dumps(weird)
+    assert env.storage.upsert({'key': key, 'value': value}) == [key]
+    i = env.sql('SELECT value FROM storage WHERE key = %s', [key])
+    assert i.fetchone()[0] == weird
+
+
+def test_sql_prepared(env):
+    env.conf.update(debug_sql=True)
+    sql = 'SELECT $1::int + 1'
+    i = env.sql_prepared('test_plus', sql, [1], ['int'], explain=True)
+    assert i.fetchone()[0] == 2
+
+    with raises(ValueError):
+        env.sql_prepared('test_update', '''
+        UPDATE storage SET value = value WHERE key = $1
+        ''', ['test'], ['varchar'], explain=True)
+
+
+def test_labels(env):
+    labels = env.labels
+    name = 'test/%s' % uuid.uuid4()
+    with patch.object(labels, 'load', wraps=labels.load) as load:
+        assert labels.get_ids(['\\Nope', name]) == [0, 0]
+        assert labels.get_ids(['\\Nope']) == [0]
+        assert load.call_count == 1
+
+        id = labels.get_id(name, create=True)
+        assert id and load.call_count == 2
+        assert labels.get_name(id) == name
+
+    # New label is created by separate connection, which gets closed
+    conns, connect = [], env.db_connect
+
+    def db_connect(**params):
+        conns.append(connect(**params))
+        return conns[-1]
+
+    with patch.object(env, 'db_connect', db_connect):
+        labels.create(['test/%s' % uuid.uuid4()])
+    assert len(conns) == 1 and conns[0].closed
@@ -0,0 +1,34 @@
+from pytest import mark
+
+from core.filters import hash_participants, humanize_subj, normalize_subj
+
+
+@mark.parametrize('subj, base, expected', [
+    ('Re: Hello', None, 'Hello'),
+    ('RE: Fwd: Hello', None, 'Hello'),
+    ('Re[2]: Hello', 'hello', 'Hello'),
+    ('Re: Hello', 'Other', 'Re: Hello'),
+    ('Re:', None, '(no subject)'),
+    (None, None, '(no subject)'),
+])
+def test_humanize_subj(subj, base, expected):
+    assert humanize_subj(subj, base) == expected
+
+
+@mark.parametrize('subj, expected', [
+    ('Hello', 'hello'),
+    (' Re: Re[2]:  Hello  world', 'hello world'),
+    ('[list] Re: [list] Fwd: Hello', 'hello'),
+    ('Re:', ''),
+    (None, ''),
+])
+def test_normalize_subj(subj, expected):
+    assert normalize_subj(subj) == expected
+
+
+def test_participants():
+    a, b, c = '"A" <a@test.com>', '"B" <B@test.com>', '"C" <c@test.com>'
+    assert hash_participants([a], [b], []) == hash_participants([b], [a], [])
+    assert hash_participants([a], [b], []) == hash_participants([a], [], [b])
+    assert hash_participants([a], [b], []) != hash_participants([a], [b], [c])
+    assert hash_participants([], [], []) == ''
@@ -1,9 +1,12 @@
 import json
+import re
+from multiprocessing.dummy import Pool as ThreadPool
+from unittest.mock import patch
 
 from pytest import mark
 
 from . import read_file
-from core import syncer
+from core import parser, syncer
 
 emails = read_file('files_parser', 'expected.json').items()
 
@@ -33,3 +36,80 @@ def test_emails(env, path, expected):
     if expected.get('refs'):
         assert 'refs' in result
         assert expected['refs'] == result['refs']
+
+
+@mark.parametrize('path', [path for path, expected in emails])
+def test_headers(env, path):
+    raw = read_file('files_parser', path)
+    header = re.split(b'\r?\n\r?\n', raw, 1)[0] + b'\r\n\r\n'
+    result = syncer.get_parsed(env, header, 'test', headers_only=True)
+    expected = syncer.get_parsed(env, header, 'test')
+    # Only full parsing sets them
+    assert result.pop('parser_version') is None
+    assert expected.pop('parser_version') == parser.VERSION
+    assert result.pop('lang') is None
+    assert expected.pop('lang')
+    assert result == expected
+
+
+@mark.parametrize('path', [path for path, expected in emails])
+def test_chunks(env, path):
+    raw = read_file('files_parser', path)
+
+    def parse(chunk_size):
+        env.files.rm('chunks')
+        with patch.object(parser.Part, 'chunk_size', chunk_size):
+            result = parser.parse(env, raw, 'chunks')
+        assets = result['attachments'] + list(result['embedded'].values())
+        return result, [env.files.read(a['path']) for a in assets]
+
+    assert parse(5) == parse(64 * 1024)
+
+
+def test_threads(env):
+    raws = [read_file('files_parser', path) for path, expected in emails]
+    expected = [parser.parse(env, raw, 'test') for raw in raws]
+    with ThreadPool(4) as pool:
+        results = pool.map(lambda r: parser.parse(env, r, 'test'), raws * 4)
+    assert results == expected * 4
+
+
+def test_charsets(env):
+    raw = read_file(
+        'files_parser', '7bcb4914-47c5-53a9-b6f0-3aa35ef0e1e0'
+        '--cp1251-wo-declaration.txt'
+    )
+    env.charsets.by_domain = {}
+    expected = parser.parse(env, raw, 'test')
+    assert env.charsets.stats['detect'] > 0
+    # A few messages should agree before charset is learned
+    assert parser.parse(env, raw, 'test') == expected
+    assert env.charsets.by_domain == {}
+    assert parser.parse(env, raw, 'test') == expected
+    assert env.charsets.by_domain == {'hostpro.com.ua': 'cp1251'}
+
+    env.charsets.stats.clear()
+    assert parser.parse(env, raw, 'test') == expected
+    assert env.charsets.stats['detect'] == 0
+    assert env.charsets.stats['domain'] > 0
+
+    # Declared charset is learned at once and replaces the guess
+    declared = raw.replace(
+        b'\nFrom:', b'\nContent-Type: text/plain; charset=koi8-r\r\nFrom:', 1
+    )
+    parser.parse(env, declared, 'test')
+    assert env.charsets.by_domain == {'hostpro.com.ua': 'koi8-r'}
+    env.db.rollback()
+
+
+@mark.parametrize('langs, text, expected', [
+    (['simple'], 'Hello, world', ['simple']),
+    (['simple', 'english'], 'Hello, world', ['english']),
+    (['simple', 'english'], 'Привет, мир', ['simple']),
+    ([], 'Привет, мир', ['russian']),
+    ([], 'Привет, world', ['english', 'russian']),
+    ([], '2016-05-01 12:00', ['simple']),
+])
+def test_langs(env, langs, text, expected):
+    env.conf['search_lang'] = langs or ['simple', 'english', 'russian']
+    assert syncer.detect_langs(env, text) == expected
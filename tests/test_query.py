@@ -1,80 +1,100 @@
-from pytest import mark
+import datetime as dt
+from unittest.mock import patch
+
+from pytest import fixture, mark
 
 from core.views import parse_query
 
+label_ids = {'\\All': 1, '\\Inbox': 2, '\\Spam': 3, '\\Unread': 4}
+
+
+@fixture
+def env(env):
+    def get_ids(names, create=False):
+        return [label_ids.get(n, 0) for n in names]
+
+    with patch.object(env.labels, 'get_ids', get_ids):
+        yield env
+
 
 @mark.parametrize('query, expected', [
     ('', (
         "SELECT id FROM emails"
-        " WHERE labels @> ARRAY['\\All']::varchar[]",
-        {'labels': ['\\All']}
+        " WHERE labels @> ARRAY[1]::int[]",
+        {'labels': ['\\All'], 'label_ids': [1]}
     )),
     ('subj:Test%', (
         "SELECT id FROM emails"
-        " WHERE subj LIKE 'Test%' AND labels @> ARRAY['\\All']::varchar[]",
+        " WHERE subj LIKE 'Test%' AND labels @> ARRAY[1]::int[]",
         {'labels': ['\\All']}
     )),
     ('subj:"Test subj"', (
         "SELECT id FROM emails"
-        " WHERE subj LIKE 'Test subj' AND labels @> ARRAY['\\All']::varchar[]",
+        " WHERE subj LIKE 'Test subj' AND labels @> ARRAY[1]::int[]",
         {'labels': ['\\All']}
     )),
     ('in:\\Inbox', (
         "SELECT id FROM emails"
-        " WHERE labels @> ARRAY['\\Inbox']::varchar[]",
-        {'labels': ['\\Inbox']}
+        " WHERE labels @> ARRAY[2]::int[]",
+        {'labels': ['\\Inbox'], 'label_ids': [2]}
     )),
     ('in:"test box"', (
         "SELECT id FROM emails"
-        " WHERE labels @> ARRAY['\\All', 'test box']::varchar[]",
-        {'labels': ['\\All', 'test box']}
+        " WHERE labels @> ARRAY[1, 0]::int[]",
+        {'labels': ['\\All', 'test box'], 'label_ids': [1, 0]}
     )),
     ('in:\\Spam', (
         "SELECT id FROM emails"
-        " WHERE labels @> ARRAY['\\Spam']::varchar[]",
-        {'labels': ['\\Spam']}
+        " WHERE labels @> ARRAY[3]::int[]",
+        {'labels': ['\\Spam'], 'label_ids': [3]}
     )),
     ('in:\\Inbox,\\Unread', (
         "SELECT id FROM emails"
-        " WHERE labels @> ARRAY['\\Inbox', '\\Unread']::varchar[]",
-        {'labels': ['\\Inbox', '\\Unread']}
+        " WHERE labels @> ARRAY[2, 4]::int[]",
+        {'labels': ['\\Inbox', '\\Unread'], 'label_ids': [2, 4]}
     )),
     ('in:\\Inbox subj:"Test 1"', (
         "SELECT id FROM emails"
-        " WHERE subj LIKE 'Test 1' AND labels @> ARRAY['\\Inbox']::varchar[]",
+        " WHERE subj LIKE 'Test 1' AND labels @> ARRAY[2]::int[]",
         {'labels': ['\\Inbox']}
     )),
     ('from:user@test.com', (
         "SELECT id FROM emails"
-        " WHERE array_to_string(fr, ',') LIKE '%<user@test.com>%'"
-        " AND labels @> ARRAY['\\All']::varchar[]",
+        " WHERE id IN (SELECT l.id FROM email_contacts l"
+        " JOIN contacts c ON c.id = l.contact_id"
+        " WHERE c.addr = 'user@test.com' AND l.field IN ('fr'))"
+        " AND labels @> ARRAY[1]::int[]",
         {'labels': ['\\All']}
     )),
     ('to:user@test.com', (
         "SELECT id FROM emails"
-        " WHERE array_to_string(\"to\" || cc, ',') LIKE '%<user@test.com>%'"
-        " AND labels @> ARRAY['\\All']::varchar[]",
+        " WHERE id IN (SELECT l.id FROM email_contacts l"
+        " JOIN contacts c ON c.id = l.contact_id"
+        " WHERE c.addr = 'user@test.com' AND l.field IN ('to', 'cc'))"
+        " AND labels @> ARRAY[1]::int[]",
         {'labels': ['\\All']}
     )),
-    ('email:q@test.com', (
+    ('email:Q@test.com', (
         "SELECT id FROM emails"
-        " WHERE array_to_string(\"to\" || cc || fr, ',') LIKE '%<q@test.com>%'"
-        " AND labels @> ARRAY['\\All']::varchar[]",
+        " WHERE id IN (SELECT l.id FROM email_contacts l"
+        " JOIN contacts c ON c.id = l.contact_id"
+        " WHERE c.addr = 'q@test.com' AND l.field IN ('to', 'cc', 'fr'))"
+        " AND labels @> ARRAY[1]::int[]",
         {'labels': ['\\All']}
     )),
     ('test', (
         "SELECT id, ts_rank(search, plainto_tsquery('simple', 'test')) AS sort"
-        " FROM emails"
+        " FROM emails JOIN bodies USING (id)"
         " WHERE search @@ (plainto_tsquery('simple', 'test'))"
-        " AND labels @> ARRAY['\\All']::varchar[]",
+        " AND labels @> ARRAY[1]::int[]",
         {'order_by': 'sort', 'labels': ['\\All']}
     )),
     ('t subj:Test t2', (
         "SELECT id, ts_rank(search, plainto_tsquery('simple', 't t2')) AS sort"
-        " FROM emails"
+        " FROM emails JOIN bodies USING (id)"
         " WHERE subj LIKE 'Test'"
         " AND search @@ (plainto_tsquery('simple', 't t2'))"
-        " AND labels @> ARRAY['\\All']::varchar[]",
+        " AND labels @> ARRAY[1]::int[]",
         {'order_by': 'sort', 'labels': ['\\All']}
     )),
 ])
@@ -84,3 +104,37 @@ def test_parsing(env, query, expected):
 
     order_by = result[1].get('order_by', 'id')
     env.sql('{} ORDER BY {} DESC'.format(result[0], order_by)).fetchone()
+
+
+def test_addresses(env):
+    addresses = env.addresses
+    addresses.checked = float('inf')
+    addresses.update([
+        (1, 'bob@test.com', 'Bob', 1, dt.datetime(2017, 1, 1)),
+        (2, 'alice@test.com', 'Alice Smith', 5, dt.datetime(2017, 1, 3)),
+        (3, 'al@test.com', None, 2, dt.datetime(2017, 1, 2)),
+    ])
+    assert addresses.search('') == [
+        '"Alice Smith" <alice@test.com>',
+        '"al" <al@test.com>',
+        '"Bob" <bob@test.com>',
+    ]
+    assert addresses.search('Al') == [
+        '"Alice Smith" <alice@test.com>',
+        '"al" <al@test.com>',
+    ]
+    assert addresses.search('ali') == ['"Alice Smith" <alice@test.com>']
+    assert addresses.search('smith') == []
+    assert addresses.search('bob@') == ['"Bob" <bob@test.com>']
+
+    addresses.update([
+        (1, 'bob@test.com', 'Bob', 2, dt.datetime(2017, 1, 4)),
+        (4, 'alan@test.com', 'Alan', 1, dt.datetime(2017, 1, 5)),
+    ])
+    assert addresses.search('') == [
+        '"Alan" <alan@test.com>',
+        '"Bob" <bob@test.com>',
+        '"Alice Smith" <alice@test.com>',
+        '"al" <al@test.com>',
+    ]
+    assert addresses.search('al')[0] == '"Alan" <alan@test.com>'
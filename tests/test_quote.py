@@ -2,7 +2,7 @@ from lxml import etree
 from pytest import mark, skip
 
 from . import open_file
-from core.filters import hide_quote
+from core.filters import get_quote, hide_quote
 
 
 @mark.parametrize('id', [1457489417718057053])
@@ -20,5 +20,21 @@ def test_thread_with_quotes(id):
 
     class_ = 'email_quote'
     for i in range(1, len(mails)):
-        res = hide_quote(mails[i]['html'], [mails[i - 1]['html']], class_)
+        quotes = [get_quote(mails[i - 1]['html'])]
+        res = hide_quote(mails[i]['html'], quotes, class_)
         assert 'class="%s"' % class_ in res
+
+
+@mark.parametrize('reply', [
+    '<div><p>Reply</p><blockquote>{}</blockquote></div>',
+    '<div><p>Reply</p><p>-----Original Message-----</p>{}</div>',
+])
+def test_quote(reply):
+    parent = '<div><p>Hello, <b>world</b>!</p><p>Bye</p></div>'
+    quotes = [get_quote('<p>Other</p>'), get_quote(parent)]
+    res = hide_quote(reply.format(parent), quotes, 'email-quote')
+    assert 'class="email-quote"' in res
+    assert 'class="email-quote-toggle"' in res
+
+    res = hide_quote(reply.format('<p>Hello</p>'), quotes, 'email-quote')
+    assert 'email-quote' not in res
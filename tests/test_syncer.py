@@ -0,0 +1,69 @@
+import datetime as dt
+from unittest.mock import patch
+
+from pytest import fixture
+
+from core import syncer
+
+
+@fixture
+def env(env):
+    env.sql('DELETE FROM emails')
+    env.db.commit()
+    with patch.object(syncer, 'notify'):
+        yield env
+    env.db.rollback()
+    env.sql('DELETE FROM emails')
+    env.db.commit()
+
+
+class Imap:
+    email = 'test@test.com'
+
+    def __init__(self, *emails):
+        self.emails = emails
+
+    def fetch_batch(self, uids, query, label):
+        yield [
+            (extid, {
+                'INTERNALDATE': dt.datetime(2017, 1, 1),
+                'RFC822.SIZE': 100,
+                'RFC822.HEADER': header.encode(),
+                'X-GM-MSGID': extid
+            })
+            for extid, header in self.emails
+        ]
+
+
+def header(msgid, subj='Test', refs=None):
+    lines = [
+        'From: "A" <a@test.com>',
+        'To: "B" <b@test.com>',
+        'Subject: %s' % subj,
+        'Message-ID: %s' % msgid,
+    ]
+    if refs:
+        lines.append('References: %s' % ' '.join(refs))
+    return '\r\n'.join(lines) + '\r\n\r\n'
+
+
+def test_fetch_headers(env):
+    ids = syncer.fetch_headers(env, Imap(('1', header('<1@test>'))), ['1'])
+    assert [uid for uid, id in ids] == ['1']
+
+    # Batch conflicts with existing extid, so it goes one by one
+    ids = syncer.fetch_headers(env, Imap(
+        ('2', header('<2@test>')),
+        ('1', header('<1@test>')),
+        ('3', header('<1@test>')),
+    ), ['2', '1', '3'])
+    assert [uid for uid, id in ids] == ['2']
+
+    i = env.sql('SELECT extid, msgid, duplicate FROM emails ORDER BY id')
+    rows = [tuple(r) for r in i]
+    first = env.sql("SELECT id FROM emails WHERE extid = '1'").fetchone()[0]
+    assert rows == [
+        ('1', '<1@test>', None),
+        ('2', '<2@test>', None),
+        ('3', None, first),
+    ]